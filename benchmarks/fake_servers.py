@@ -0,0 +1,297 @@
+#benchmarks/fake_servers.py
+# Локальные заглушки Telegram Bot API и OpenRouter для нагрузочного тестирования
+import json
+import math
+import random
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Признак конца ответа: по нему имитатор пользователя понимает, что ответ показан целиком
+REPLY_SENTINEL = '[конец]'
+
+
+def _start(server):
+    # Клиенты закрывают keep-alive соединения при остановке; это не ошибка заглушки
+    server.handle_error = lambda request, client_address: None
+    threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True).start()
+    return server
+
+
+class _FakeServer(ThreadingHTTPServer):
+    # Очередь входящих соединений рассчитана на сотни одновременных клиентов
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if not raw:
+            return {}
+        if 'application/json' in (self.headers.get('Content-Type') or ''):
+            return json.loads(raw)
+        return {key: values[0] for key, values in parse_qs(raw.decode('utf-8')).items()}
+
+    def send_json(self, payload, status: int = 200, headers: dict = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegram(_FakeServer):
+    """Заглушка Bot API: очередь входящих обновлений для getUpdates и журнал исходящих сообщений.
+
+    После setWebhook обновления не копятся в очереди, а отправляются POST-запросом на адрес
+    webhook. Все sendMessage/editMessageText записываются по чатам; wait_for() позволяет
+    дождаться нужного ответа в конкретном чате.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        super().__init__((host, port), _TelegramHandler)
+        self.condition = threading.Condition()
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.outgoing = defaultdict(list)  # chat_id -> [(время, метод, текст)]
+        self.chat_actions = 0
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.ready = threading.Event()  # бот начал getUpdates или зарегистрировал webhook
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/bot'
+
+    def push_message(self, user_id: int, text: str):
+        if self.webhook_url:
+            self.deliver(self.build_update(user_id, text))
+            return
+        with self.condition:
+            self.updates.append(self.build_update(user_id, text))
+            self.condition.notify_all()
+
+    def build_update(self, user_id: int, text: str) -> dict:
+        with self.condition:
+            update = {
+                'update_id': self.next_update_id,
+                'message': {
+                    'message_id': self.next_message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+                    'text': text,
+                },
+            }
+            if text.startswith('/'):
+                command = text.split()[0]
+                update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+            self.next_update_id += 1
+            self.next_message_id += 1
+            return update
+
+    def deliver(self, update: dict):
+        # Как и настоящий Telegram, повторяет доставку, пока webhook не ответит 2xx
+        request = urllib.request.Request(self.webhook_url, data=json.dumps(update).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        if self.webhook_secret:
+            request.add_header('X-Telegram-Bot-Api-Secret-Token', self.webhook_secret)
+        while True:
+            try:
+                with urllib.request.urlopen(request, timeout=10):
+                    return
+            except OSError:
+                time.sleep(0.1)
+
+    def take_updates(self, offset: int, timeout: float) -> list:
+        self.ready.set()
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return list(self.updates)
+
+    def record(self, chat_id: int, method: str, text: str):
+        with self.condition:
+            self.outgoing[chat_id].append((time.perf_counter(), method, text))
+            self.condition.notify_all()
+
+    def wait_for(self, chat_id: int, predicate, since: int, timeout: float):
+        """Ждёт исходящее сообщение в чате, удовлетворяющее predicate(text); возвращает его время или None."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for sent_at, method, text in self.outgoing[chat_id][since:]:
+                    if predicate(text):
+                        return sent_at
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def next_id(self) -> int:
+        with self.condition:
+            self.next_message_id += 1
+            return self.next_message_id
+
+
+class _TelegramHandler(_JsonHandler):
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        server = self.server
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+        data = self.read_body()
+        bot_user = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+
+        if method == 'getMe':
+            self.send_json({'ok': True, 'result': bot_user})
+        elif method == 'setWebhook':
+            server.webhook_url = data.get('url') or None
+            server.webhook_secret = data.get('secret_token')
+            server.ready.set()
+            self.send_json({'ok': True, 'result': True})
+        elif method == 'deleteWebhook':
+            server.webhook_url = None
+            self.send_json({'ok': True, 'result': True})
+        elif method == 'getUpdates':
+            updates = server.take_updates(int(data.get('offset') or 0), float(data.get('timeout') or 0))
+            self.send_json({'ok': True, 'result': updates})
+        elif method == 'sendChatAction':
+            server.chat_actions += 1
+            self.send_json({'ok': True, 'result': True})
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(data['chat_id'])
+            text = data.get('text', '')
+            server.record(chat_id, method, text)
+            message_id = int(data.get('message_id') or server.next_id())
+            self.send_json({'ok': True, 'result': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': bot_user,
+                'text': text,
+            }})
+        else:
+            self.send_json({'ok': True, 'result': True})
+
+
+class FakeOpenRouter(_FakeServer):
+    """Заглушка OpenRouter: задержка по логнормальному распределению, поток SSE и доля ошибок."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency_median: float = 0.5,
+                 latency_sigma: float = 0.5, first_token_share: float = 0.2, error_rate: float = 0.0,
+                 reply_chars: int = 400, stream_chunks: int = 20):
+        super().__init__((host, port), _OpenRouterHandler)
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.first_token_share = first_token_share
+        self.error_rate = error_rate
+        self.reply_chars = reply_chars
+        self.stream_chunks = stream_chunks
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def completions_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/api/v1/chat/completions'
+
+    @property
+    def auth_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/api/v1/auth/key'
+
+    def sample_latency(self) -> float:
+        if self.latency_median <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+
+    def reply_text(self) -> str:
+        words = []
+        length = 0
+        while length < self.reply_chars:
+            # Кириллица проверяет декодирование потока: OpenRouter передаёт UTF-8 без charset
+            word = random.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'привет', 'мир'))
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words) + ' ' + REPLY_SENTINEL
+
+
+class _OpenRouterHandler(_JsonHandler):
+    def do_GET(self):
+        # /api/v1/auth/key
+        self.send_json({'data': {'label': 'bench', 'usage': 0, 'limit': None}})
+
+    def do_POST(self):
+        server = self.server
+        payload = self.read_body()
+        with server._lock:
+            server.requests += 1
+            failed = random.random() < server.error_rate
+            if failed:
+                server.errors += 1
+        latency = server.sample_latency()
+        if failed:
+            time.sleep(latency * server.first_token_share)
+            self.send_json({'error': {'message': 'fake upstream error'}}, status=random.choice((429, 500, 502)),
+                           headers={'Retry-After': '0'})
+            return
+
+        text = server.reply_text()
+        usage = {
+            'prompt_tokens': sum(len(message.get('content', '')) for message in payload.get('messages', [])) // 4,
+            'completion_tokens': len(text) // 4,
+        }
+        if not payload.get('stream'):
+            time.sleep(latency)
+            self.send_json({'choices': [{'message': {'role': 'assistant', 'content': text}}], 'usage': usage})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        time.sleep(latency * server.first_token_share)
+        self.write_chunk(': OPENROUTER PROCESSING\n\n')
+        pieces = max(1, server.stream_chunks)
+        step = math.ceil(len(text) / pieces)
+        delay = latency * (1 - server.first_token_share) / pieces
+        for start in range(0, len(text), step):
+            delta = {'choices': [{'delta': {'content': text[start:start + step]}}]}
+            self.write_chunk(f'data: {json.dumps(delta, ensure_ascii=False)}\n\n')
+            time.sleep(delay)
+        self.write_chunk(f"data: {json.dumps({'choices': [{'delta': {}}], 'usage': usage})}\n\n")
+        self.write_chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text: str):
+        data = text.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+
+def start_fake_telegram(**kwargs) -> FakeTelegram:
+    return _start(FakeTelegram(**kwargs))
+
+
+def start_fake_openrouter(**kwargs) -> FakeOpenRouter:
+    return _start(FakeOpenRouter(**kwargs))
@@ -0,0 +1,332 @@
+#benchmarks/load_test.py
+# Нагрузочный тест бота без реальных токенов и пользователей.
+#
+# Запуск из корня репозитория:
+#     python -m benchmarks.load_test --users 100 --messages 5 --output bench_result.json
+#     python -m benchmarks.load_test --baseline bench_result.json
+#     python -m benchmarks.load_test --webhook --workers 4
+#     python -m benchmarks.load_test --latency-sigma 1.5 --hedge
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from benchmarks.fake_servers import REPLY_SENTINEL, start_fake_openrouter, start_fake_telegram
+
+# Первая модель с достаточным окном, чтобы история не обрезалась слишком агрессивно
+BENCH_MODEL = 'openai/gpt-3.5-turbo-16k'
+# Резервная модель пользователей при --hedge; у заглушки то же распределение задержек
+BENCH_FALLBACK_MODEL = 'mistralai/mistral-7b-instruct'
+BENCH_API_KEY = 'sk-or-bench-key'
+FIRST_USER_ID = 100000
+# Распределение длины истории одинаково от запуска к запуску, самые длинные - не больше пяти средних
+HISTORY_SEED = 20240101
+HISTORY_MAX_FACTOR = 5
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Offline load test with fake Telegram and OpenRouter servers')
+    parser.add_argument('--users', type=int, default=50, help='number of concurrent simulated users')
+    parser.add_argument('--messages', type=int, default=5, help='messages sent by each user')
+    parser.add_argument('--history', type=int, default=200,
+                        help='mean stored history length per user (exponentially distributed)')
+    parser.add_argument('--think-time', type=float, default=0.0, help='pause between messages of one user, s')
+    parser.add_argument('--latency', type=float, default=0.5, help='median upstream latency, s')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='sigma of the lognormal latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream requests failing')
+    parser.add_argument('--reply-chars', type=int, default=400, help='length of generated replies')
+    parser.add_argument('--stream', dest='stream', action='store_true', default=None, help='force streaming')
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help='disable streaming')
+    parser.add_argument('--webhook', action='store_true', help='deliver updates through the webhook mode')
+    parser.add_argument('--workers', type=int, default=4, help='update worker processes in webhook mode')
+    parser.add_argument('--hedge', action='store_true', help='give every user a fallback model for hedged requests')
+    parser.add_argument('--timeout', type=float, default=120.0, help='per-message timeout, s')
+    parser.add_argument('--output', default='bench_result.json', help='where to save the JSON report')
+    parser.add_argument('--baseline', help='previous JSON report to compare against')
+    return parser.parse_args(argv)
+
+
+def configure(args, workdir: str, telegram, openrouter_server):
+    # Настройки подменяются до импорта модулей бота, которые читают их при импорте
+    import config
+    config.DATABASE_URL = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    config.LOG_FILE = os.path.join(workdir, 'bench.log.jsonl')
+    config.LOG_LEVEL = 'WARNING'
+    config.TELEGRAM_BOT_TOKEN = '123456:bench'
+    config.TELEGRAM_BASE_URL = telegram.base_url
+    config.API_VALIDATE_URL = openrouter_server.auth_url
+    config.METRICS_ENABLED = False
+    # Имитаторы пользователей отправляют сообщения чаще пользовательского лимита
+    config.USER_RATE_LIMIT_PER_MIN = 0
+    config.MODEL_RATE_LIMIT_PER_MIN = 0
+    # У заглушки Telegram нет общего лимита Bot API; ограничение на чат остаётся как в рабочем режиме
+    config.TELEGRAM_GLOBAL_RATE = 10000
+    config.TELEGRAM_GLOBAL_BURST = 10000
+    if args.stream is not None:
+        config.STREAM_RESPONSES = args.stream
+    if args.hedge:
+        # Короткий прогон: порог страховки оценивается по первым запросам, а не через 20
+        config.HEDGE_MIN_SAMPLES = 10
+        config.HEDGE_MIN_DELAY = 0.05
+    if args.webhook:
+        config.UPDATE_MODE = 'webhook'
+        config.WEBHOOK_LISTEN = '127.0.0.1'
+        config.WEBHOOK_PORT = free_port()
+        config.WEBHOOK_URL = f'http://127.0.0.1:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}'
+        config.WEBHOOK_SECRET = 'bench-secret'
+        config.WEBHOOK_WORKERS = args.workers
+
+    import openrouter
+    openrouter.API_URL = openrouter_server.completions_url
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def seed_database(args):
+    import db
+    from models import Message, User
+    db.init_db()
+    now = datetime.now()
+    with db.SessionLocal() as session:
+        users = [User(telegram_id=FIRST_USER_ID + index, api_key=BENCH_API_KEY, model_id=BENCH_MODEL,
+                      max_tokens=4096, is_valid=True, fallback_model_id=BENCH_FALLBACK_MODEL if args.hedge else None)
+                 for index in range(args.users)]
+        session.add_all(users)
+        session.flush()
+        rows = []
+        # Длина истории у пользователей разная: много коротких диалогов и немного длинных
+        rng = random.Random(HISTORY_SEED)
+        for user in users:
+            length = int(rng.expovariate(1 / args.history)) if args.history else 0
+            length = min(length, HISTORY_MAX_FACTOR * args.history)
+            for index in range(length):
+                text = f'history message {index} ' + 'lorem ipsum ' * (5 + index % 40)
+                rows.append(dict(user_id=user.id, text=text, timestamp=now, direction='in' if index % 2 == 0 else 'out'))
+        session.bulk_insert_mappings(Message, rows)
+        session.commit()
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _process_tree(root: int) -> list:
+    # Сам процесс и все его потомки (процессы-обработчики webhook-режима)
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as stat:
+                # Имя процесса в скобках может содержать пробелы, ppid идёт вторым полем после него
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    tree = [root]
+    for pid in tree:
+        tree.extend(children.get(pid, ()))
+    return tree
+
+
+def rss_mb() -> dict:
+    """Текущая и пиковая память бота: сумма по процессу теста и всем процессам-обработчикам."""
+    result = {}
+    try:
+        pids = _process_tree(os.getpid())
+    except OSError:
+        return result
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    for field, key in (('VmRSS:', 'rss_mb'), ('VmHWM:', 'max_rss_mb')):
+                        if line.startswith(field):
+                            result[key] = result.get(key, 0.0) + int(line.split()[1]) / 1024
+        except OSError:
+            continue
+    result['processes'] = len(pids)
+    return result
+
+
+def simulate_user(telegram, user_id: int, args, results: list, lock: threading.Lock):
+    def finished(text):
+        return text.endswith(REPLY_SENTINEL) or text.startswith('Извините')
+
+    for index in range(args.messages):
+        since = len(telegram.outgoing[user_id])
+        started = time.perf_counter()
+        telegram.push_message(user_id, f'benchmark question {index} from {user_id}')
+        first = telegram.wait_for(user_id, lambda text: True, since, args.timeout)
+        done = telegram.wait_for(user_id, finished, since, args.timeout) if first else None
+        failed = done is None or not telegram.outgoing[user_id][-1][2].endswith(REPLY_SENTINEL)
+        with lock:
+            results.append({
+                'first_response': (first - started) if first else None,
+                'latency': (done - started) if done else None,
+                'failed': failed,
+            })
+        if args.think_time:
+            time.sleep(args.think_time)
+
+
+def run_load(args, telegram, report: dict):
+    telegram.ready.wait(30)
+    results = []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=simulate_user, args=(telegram, FIRST_USER_ID + index, args, results, lock),
+                                daemon=True) for index in range(args.users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report['elapsed'] = time.perf_counter() - started
+    report['samples'] = results
+    report.update(rss_mb())
+    # Бот завершается по SIGINT так же, как при остановке вручную
+    os.kill(os.getpid(), signal.SIGINT)
+
+
+def summarize(args, report: dict, openrouter_server, telegram) -> dict:
+    from metrics import stage_duration, upstream_hedges_total
+    samples = report['samples']
+    latencies = [sample['latency'] for sample in samples if sample['latency'] is not None]
+    first_responses = [sample['first_response'] for sample in samples if sample['first_response'] is not None]
+    stage_totals = stage_duration.totals('stage')
+    db_count = sum(count for stage, (count, _) in stage_totals.items() if stage.startswith('db_'))
+    db_seconds = sum(total for stage, (_, total) in stage_totals.items() if stage.startswith('db_'))
+    completed = len(latencies)
+    return {
+        'messages': len(samples),
+        'completed': completed,
+        'failed': sum(1 for sample in samples if sample['failed']),
+        'elapsed_s': report['elapsed'],
+        'messages_per_sec': completed / report['elapsed'] if report['elapsed'] else 0.0,
+        'latency_s': {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies, default=0.0),
+        },
+        'first_response_s': {
+            'p50': percentile(first_responses, 0.50),
+            'p95': percentile(first_responses, 0.95),
+            'p99': percentile(first_responses, 0.99),
+        },
+        'db': {
+            'operations': db_count,
+            'total_s': db_seconds,
+            'per_message_ms': 1000 * db_seconds / len(samples) if samples else 0.0,
+            'stages': {stage: {'count': count, 'total_s': total}
+                       for stage, (count, total) in sorted(stage_totals.items()) if stage.startswith('db_')},
+        },
+        'upstream': {'requests': openrouter_server.requests, 'errors': openrouter_server.errors,
+                     'hedged': upstream_hedges_total.total()},
+        'telegram': {'chat_actions': telegram.chat_actions},
+        'rss_mb': report.get('rss_mb'),
+        'max_rss_mb': report.get('max_rss_mb'),
+        'processes': report.get('processes'),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results: dict, baseline: dict):
+    print('\nComparison with baseline (%s):' % baseline.get('revision', '?'))
+    rows = [
+        ('messages/sec', ('messages_per_sec',)),
+        ('latency p50, s', ('latency_s', 'p50')),
+        ('latency p95, s', ('latency_s', 'p95')),
+        ('latency p99, s', ('latency_s', 'p99')),
+        ('first response p50, s', ('first_response_s', 'p50')),
+        ('db per message, ms', ('db', 'per_message_ms')),
+        ('max rss, MB', ('max_rss_mb',)),
+    ]
+    for title, path in rows:
+        old, new = baseline['results'], results
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if old is None or new is None:
+            continue
+        change = f'{(new - old) / old:+.1%}' if old else 'n/a'
+        print(f'  {title:<24} {old:>10.3f} -> {new:>10.3f}  ({change})')
+
+
+def print_results(results: dict):
+    print(f"Messages: {results['completed']}/{results['messages']} completed, {results['failed']} failed, "
+          f"{results['elapsed_s']:.1f} s")
+    print(f"Throughput: {results['messages_per_sec']:.1f} messages/sec")
+    latency = results['latency_s']
+    print(f"End-to-end latency: p50 {latency['p50']:.3f} s, p95 {latency['p95']:.3f} s, p99 {latency['p99']:.3f} s")
+    first = results['first_response_s']
+    print(f"First response: p50 {first['p50']:.3f} s, p95 {first['p95']:.3f} s, p99 {first['p99']:.3f} s")
+    upstream = results['upstream']
+    print(f"Upstream: {upstream['requests']} requests, {upstream['errors']} errors, {upstream['hedged']:g} hedged")
+    print(f"DB time: {results['db']['total_s']:.3f} s total, {results['db']['per_message_ms']:.2f} ms per message")
+    print(f"RSS: {results.get('rss_mb') or 0:.1f} MB (max {results.get('max_rss_mb') or 0:.1f} MB) "
+          f"across {results.get('processes') or 1} processes")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='openbot-bench-')
+    try:
+        telegram = start_fake_telegram()
+        openrouter_server = start_fake_openrouter(latency_median=args.latency, latency_sigma=args.latency_sigma,
+                                                  error_rate=args.error_rate, reply_chars=args.reply_chars)
+        configure(args, workdir, telegram, openrouter_server)
+        seed_database(args)
+
+        import main as bot
+        report = {}
+        threading.Thread(target=run_load, args=(args, telegram, report), name='load', daemon=True).start()
+        bot.main()
+    finally:
+        # База с историей всех имитируемых пользователей и лог занимают заметное место
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = summarize(args, report, openrouter_server, telegram)
+    print_results(results)
+    if args.webhook:
+        print('DB time is not collected in webhook mode: it is measured inside the worker processes')
+    document = {
+        'revision': git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            compare(results, json.load(baseline_file))
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(document, output, indent=2, ensure_ascii=False)
+    print(f'\nSaved to {args.output}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#benchmarks/startup.py
+# Время холодного запуска бота: импорт модулей и init_db() в отдельном процессе.
+#
+# Запуск из корня репозитория:
+#     python -m benchmarks.startup
+#     python -m benchmarks.startup --runs 10 --budget 1.5
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Выполняется в пустом временном каталоге: относительные пути базы и лога указывают в него
+PROBE = '''
+import json, os, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter() - started
+side_effects = sorted(os.listdir('.'))
+import db
+started = time.perf_counter()
+db.init_db()
+fresh = time.perf_counter() - started
+started = time.perf_counter()
+db.init_db()
+existing = time.perf_counter() - started
+print(json.dumps({'import_s': imported, 'init_fresh_s': fresh, 'init_existing_s': existing,
+                  'side_effects': side_effects}))
+'''
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Cold start time of the bot modules and database initialization')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh processes to measure')
+    parser.add_argument('--budget', type=float, help='allowed import + init_db() time, s (default: STARTUP_TIME_BUDGET)')
+    return parser.parse_args(argv)
+
+
+def measure_once() -> dict:
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    with tempfile.TemporaryDirectory(prefix='openbot-startup-') as workdir:
+        started = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=workdir, env=env, text=True)
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process_s'] = time.perf_counter() - started
+    return result
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, REPO_ROOT)
+    from config import STARTUP_TIME_BUDGET
+    budget = STARTUP_TIME_BUDGET if args.budget is None else args.budget
+
+    runs = [measure_once() for _ in range(args.runs)]
+    for key, title in (('import_s', 'import main'), ('init_fresh_s', 'init_db(), new database'),
+                       ('init_existing_s', 'init_db(), migrated database'), ('process_s', 'whole process')):
+        values = [run[key] for run in runs]
+        print(f'{title:<30} median {median(values):.3f} s, max {max(values):.3f} s')
+
+    startup = median([run['import_s'] + run['init_fresh_s'] for run in runs])
+    side_effects = sorted({name for run in runs for name in run['side_effects']})
+    failed = False
+    if side_effects:
+        print(f'Importing main created files: {", ".join(side_effects)}')
+        failed = True
+    if startup > budget:
+        print(f'Startup {startup:.3f} s is over the {budget:.3f} s budget')
+        failed = True
+    else:
+        print(f'Startup {startup:.3f} s is within the {budget:.3f} s budget')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,91 +1,258 @@
-# config.py
-
-# Токен вашего бота в Telegram, который вы получите от @BotFather
-TELEGRAM_BOT_TOKEN = '{YOUR API KEY}'
-
-# Путь к файлу логирования
-LOG_FILE = 'log.txt'
-
-# Настройки подключения к базе данных SQLite
-DATABASE_URL = 'sqlite:///chatbot.db'
-
-API_VALIDATE_URL = 'https://openrouter.ai/api/v1/validate_key'
-
-# Список доступных моделей для выбора
-AVAILABLE_MODELS = {
-    1: {"name": "openrouter/auto", "max_tokens": 128000},
-    2: {"name": "nousresearch/nous-capybara-7b", "max_tokens": 4096},
-    3: {"name": "mistralai/mistral-7b-instruct", "max_tokens": 8192},
-    4: {"name": "huggingfaceh4/zephyr-7b-beta", "max_tokens": 4096},
-    5: {"name": "openchat/openchat-7b", "max_tokens": 8192},
-    6: {"name": "gryphe/mythomist-7b", "max_tokens": 32768},
-    7: {"name": "openrouter/cinematika-7b", "max_tokens": 8000},
-    8: {"name": "rwkv/rwkv-5-world-3b", "max_tokens": 10000},
-    9: {"name": "recursal/rwkv-5-3b-ai-town", "max_tokens": 10000},
-    10: {"name": "recursal/eagle-7b", "max_tokens": 10000},
-    11: {"name": "jondurbin/bagel-34b", "max_tokens": 8000},
-    12: {"name": "jebcarter/psyfighter-13b", "max_tokens": 4096},
-    13: {"name": "koboldai/psyfighter-13b-2", "max_tokens": 4096},
-    14: {"name": "neversleep/noromaid-mixtral-8x7b-instruct", "max_tokens": 8000},
-    15: {"name": "nousresearch/nous-hermes-llama2-13b", "max_tokens": 4096},
-    16: {"name": "meta-llama/codellama-34b-instruct", "max_tokens": 8192},
-    17: {"name": "phind/phind-codellama-34b", "max_tokens": 4096},
-    18: {"name": "intel/neural-chat-7b", "max_tokens": 4096},
-    19: {"name": "nousresearch/nous-hermes-2-mixtral-8x7b-dpo", "max_tokens": 32000},
-    20: {"name": "nousresearch/nous-hermes-2-mixtral-8x7b-sft", "max_tokens": 32000},
-    21: {"name": "haotian-liu/llava-13b", "max_tokens": 2048},
-    22: {"name": "nousresearch/nous-hermes-2-vision-7b", "max_tokens": 4096},
-    23: {"name": "meta-llama/llama-2-13b-chat", "max_tokens": 4096},
-    24: {"name": "gryphe/mythomax-l2-13b", "max_tokens": 4096},
-    25: {"name": "nousresearch/nous-hermes-llama2-70b", "max_tokens": 4096},
-    26: {"name": "teknium/openhermes-2-mistral-7b", "max_tokens": 4096},
-    27: {"name": "teknium/openhermes-2.5-mistral-7b", "max_tokens": 4096},
-    28: {"name": "undi95/remm-slerp-l2-13b", "max_tokens": 4096},
-    29: {"name": "undi95/toppy-m-7b", "max_tokens": 4096},
-    30: {"name": "01-ai/yi-34b-chat", "max_tokens": 4096},
-    31: {"name": "01-ai/yi-6b", "max_tokens": 4096},
-    32: {"name": "togethercomputer/stripedhyena-nous-7b", "max_tokens": 32768},
-    33: {"name": "togethercomputer/stripedhyena-hessian-7b", "max_tokens": 32768},
-    34: {"name": "mistralai/mixtral-8x7b", "max_tokens": 32768},
-    35: {"name": "nousresearch/nous-hermes-yi-34b", "max_tokens": 4096},
-    36: {"name": "open-orca/mistral-7b-openorca", "max_tokens": 8192},
-    37: {"name": "openai/gpt-3.5-turbo", "max_tokens": 4095},
-    38: {"name": "openai/gpt-3.5-turbo-16k", "max_tokens": 16385},
-    39: {"name": "openai/gpt-4-turbo-preview", "max_tokens": 128000},
-    40: {"name": "openai/gpt-4", "max_tokens": 8191},
-    41: {"name": "openai/gpt-4-32k", "max_tokens": 32767},
-    42: {"name": "openai/gpt-4-vision-preview", "max_tokens": 128000},
-    43: {"name": "openai/gpt-3.5-turbo-instruct", "max_tokens": 4095},
-    44: {"name": "google/palm-2-chat-bison", "max_tokens": 36864},
-    45: {"name": "google/palm-2-codechat-bison", "max_tokens": 28672},
-    46: {"name": "google/palm-2-chat-bison-32k", "max_tokens": 131072},
-    47: {"name": "google/palm-2-codechat-bison-32k", "max_tokens": 131072},
-    48: {"name": "google/gemini-pro", "max_tokens": 131040},
-    49: {"name": "google/gemini-pro-vision", "max_tokens": 65536},
-    50: {"name": "perplexity/pplx-70b-online", "max_tokens": 4096},
-    51: {"name": "perplexity/pplx-7b-online", "max_tokens": 4096},
-    52: {"name": "perplexity/pplx-7b-chat", "max_tokens": 8192},
-    53: {"name": "perplexity/pplx-70b-chat", "max_tokens": 4096},
-    54: {"name": "meta-llama/llama-2-70b-chat", "max_tokens": 4096},
-    55: {"name": "nousresearch/nous-capybara-34b", "max_tokens": 32768},
-    56: {"name": "jondurbin/airoboros-l2-70b", "max_tokens": 4096},
-    57: {"name": "austism/chronos-hermes-13b", "max_tokens": 4096},
-    58: {"name": "migtissera/synthia-70b", "max_tokens": 8192},
-    59: {"name": "pygmalionai/mythalion-13b", "max_tokens": 8192},
-    60: {"name": "undi95/remm-slerp-l2-13b-6k", "max_tokens": 6144},
-    61: {"name": "xwin-lm/xwin-lm-70b", "max_tokens": 8192},
-    62: {"name": "gryphe/mythomax-l2-13b-8k", "max_tokens": 8192},
-    63: {"name": "alpindale/goliath-120b", "max_tokens": 6144},
-    64: {"name": "lizpreciatior/lzlv-70b-fp16-hf", "max_tokens": 4096},
-    65: {"name": "neversleep/noromaid-20b", "max_tokens": 8192},
-    66: {"name": "mistralai/mixtral-8x7b-instruct", "max_tokens": 32768},
-    67: {"name": "cognitivecomputations/dolphin-mixtral-8x7b", "max_tokens": 32000},
-    68: {"name": "anthropic/claude-2", "max_tokens": 200000},
-    69: {"name": "anthropic/claude-2.0", "max_tokens": 100000},
-    70: {"name": "anthropic/claude-instant-v1", "max_tokens": 100000},
-    71: {"name": "mancer/weaver", "max_tokens": 8000},
-    72: {"name": "mistralai/mistral-tiny", "max_tokens": 32000},
-    73: {"name": "mistralai/mistral-small", "max_tokens": 32000},
-    74: {"name": "mistralai/mistral-medium", "max_tokens": 32000},
-}
-
+# config.py
+
+# Токен вашего бота в Telegram, который вы получите от @BotFather
+TELEGRAM_BOT_TOKEN = '{YOUR API KEY}'
+# Адрес Bot API (можно заменить на локальный сервер или заглушку для нагрузочных тестов)
+TELEGRAM_BASE_URL = 'https://api.telegram.org/bot'
+
+# Путь к файлу логирования (одна JSON-запись на строку)
+LOG_FILE = 'log.jsonl'
+LOG_LEVEL = 'INFO'
+# Максимальное число записей в очереди логирования; при переполнении записи отбрасываются
+LOG_QUEUE_SIZE = 10000
+# Доля подробных записей (тела запросов и ответов OpenRouter), попадающих в лог
+LOG_VERBOSE_SAMPLE_RATE = 0.01
+# Длинные строки в телах запросов заменяются началом такой длины и хэшем
+LOG_BODY_PREVIEW = 200
+# Максимальная длина сообщения одной записи лога
+LOG_MAX_MESSAGE_LENGTH = 4000
+# Логирование каждого SQL-запроса SQLAlchemy (только для отладки)
+SQL_ECHO = False
+
+# Настройки подключения к базе данных SQLite
+DATABASE_URL = 'sqlite:///chatbot.db'
+
+# Лёгкий эндпоинт со сведениями о ключе: проверка без платного запроса к модели
+API_VALIDATE_URL = 'https://openrouter.ai/api/v1/auth/key'
+# Кэш результатов проверки API ключей: максимальное число записей и время жизни (в секундах)
+API_KEY_CACHE_SIZE = 10000
+API_KEY_CACHE_TTL = 3600
+
+# Клиент OpenRouter: таймауты соединения и чтения (в секундах)
+OPENROUTER_CONNECT_TIMEOUT = 5
+OPENROUTER_READ_TIMEOUT = 120
+# Повторы при ошибках соединения, 429 и 5xx: число попыток и экспоненциальная задержка с джиттером
+OPENROUTER_MAX_RETRIES = 3
+OPENROUTER_BACKOFF_BASE = 0.5
+OPENROUTER_BACKOFF_MAX = 10
+# Если Retry-After просит ждать дольше, ошибка возвращается пользователю сразу
+OPENROUTER_RETRY_AFTER_MAX = 30
+# Размер пула keep-alive соединений (не меньше MAX_CONCURRENT_UPDATES)
+OPENROUTER_POOL_SIZE = 64
+# Автомат для модели размыкается после стольких ошибок подряд...
+CIRCUIT_BREAKER_THRESHOLD = 5
+# ...и пропускает пробный запрос через столько секунд
+CIRCUIT_BREAKER_RESET = 30
+# Страховочные запросы (/fallback): если первый фрагмент ответа основной модели не пришёл
+# за HEDGE_PERCENTILE её недавних запросов, тот же запрос уходит резервной модели
+HEDGE_PERCENTILE = 0.95
+# Сколько последних запросов к модели учитывается и сколько нужно для оценки квантиля
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+# Ожидание до страховочного запроса, пока наблюдений мало, и нижняя граница ожидания (секунды)
+HEDGE_DEFAULT_DELAY = 10
+HEDGE_MIN_DELAY = 1
+# Резервная модель с окном меньше этой доли окна основной не принимается: история в неё почти не поместится
+FALLBACK_MIN_CONTEXT_SHARE = 0.25
+
+# Метрики: HTTP-эндпоинт в текстовом формате Prometheus (http://METRICS_HOST:METRICS_PORT/metrics)
+METRICS_ENABLED = True
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+# Telegram ID администраторов, которым доступна команда /stats
+ADMIN_IDS = []
+
+# Асинхронная диспетчеризация обновлений: разные чаты обрабатываются параллельно,
+# обновления одного чата - строго по очереди
+ASYNC_DISPATCH = True
+# Глобальный лимит одновременно обрабатываемых обновлений
+MAX_CONCURRENT_UPDATES = 64
+# Интервал (в секундах) повторной отправки индикатора "печатает..."
+TYPING_ACTION_INTERVAL = 4
+
+# Источник обновлений: 'polling' (getUpdates в одном процессе) или 'webhook'
+UPDATE_MODE = 'polling'
+# Webhook: локальный HTTP-сервер принимает обновления на WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+# Публичный адрес, регистрируемый в Telegram при запуске (None - webhook настроен вручную)
+WEBHOOK_URL = None
+# Секрет, который Telegram передаёт в заголовке X-Telegram-Bot-Api-Secret-Token (None - не проверяется)
+WEBHOOK_SECRET = None
+# Число процессов-обработчиков; обновления одного чата всегда обрабатывает один и тот же процесс.
+WEBHOOK_WORKERS = 4
+# Размер очереди обновлений каждого процесса; при переполнении Telegram получает 503 и повторит доставку
+WEBHOOK_QUEUE_SIZE = 10000
+
+# Ограничение частоты сообщений, отправляемых модели: сообщений в минуту и запас на всплеск (0 - без ограничения)
+USER_RATE_LIMIT_PER_MIN = 20
+USER_RATE_LIMIT_BURST = 5
+# То же для всех пользователей одной модели вместе
+MODEL_RATE_LIMIT_PER_MIN = 600
+MODEL_RATE_LIMIT_BURST = 60
+# Не чаще одного уведомления о превышении лимита за столько секунд на пользователя
+RATE_LIMIT_NOTICE_INTERVAL = 10
+# Максимум одновременных запросов к OpenRouter; сверх него запросы ждут, пользователи обслуживаются
+# по кругу (0 - без ограничения). В webhook-режиме лимиты модели и этот лимит действуют в каждом процессе
+UPSTREAM_MAX_CONCURRENT = 32
+
+# Потоковая выдача ответов (SSE, stream: true) с постепенным редактированием сообщения
+STREAM_RESPONSES = True
+# Минимальный интервал (в секундах) между редактированиями сообщения в одном чате
+STREAM_EDIT_INTERVAL = 1.5
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Лимиты Bot API на исходящие сообщения (вместе с редактированием): всего в секунду и запас на всплеск...
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_GLOBAL_BURST = 30
+# ...в один чат в секунду, запас на всплеск...
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+# ...и в одну группу в минуту
+TELEGRAM_GROUP_RATE_PER_MIN = 20
+# Сколько раз повторять отправку после ответа 429 (retry_after)
+TELEGRAM_SEND_RETRIES = 3
+
+# Сборка контекста: верхняя граница токенов истории, отправляемой в одном запросе
+MAX_HISTORY_TOKENS = 16000
+# Доля контекстного окна модели, резервируемая под ответ
+CONTEXT_REPLY_RESERVE = 0.25
+# Заменять отброшенное начало диалога кратким содержанием (требует дополнительного запроса к модели)
+CONTEXT_SUMMARY = False
+# Максимальная длина краткого содержания в токенах
+CONTEXT_SUMMARY_TOKENS = 512
+# Краткое содержание обновляется, когда накопилось столько токенов ещё не учтённой истории
+CONTEXT_SUMMARY_MIN_TOKENS = 1000
+
+# Размер страницы при постраничном чтении истории сообщений
+HISTORY_PAGE_SIZE = 50
+
+# Кэш профилей пользователей в памяти процесса: максимальное число записей и время жизни (в секундах)
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+# Время жизни профиля при нескольких процессах webhook: у каждого процесса свой кэш, и изменение
+# (/api, /model, /fallback) в одном процессе не сбрасывает профиль в остальных
+WEBHOOK_USER_CACHE_TTL = 2
+
+# Отложенная пакетная запись сообщений: одна транзакция на пачку вместо коммита на каждую строку
+MESSAGE_WRITE_BEHIND = True
+# Пачка записывается, когда набралось столько строк...
+MESSAGE_BATCH_SIZE = 200
+# ...или прошло столько секунд с момента появления первой строки
+MESSAGE_FLUSH_INTERVAL = 0.05
+
+# Кэш готовых ответов для одинаковых запросов (модель, max_tokens, сообщения); по умолчанию выключен
+RESPONSE_CACHE_ENABLED = False
+# Максимальное число ответов в памяти и время жизни ответа (в секундах)
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_TTL = 3600
+# Дублировать кэш в таблицу response_cache, чтобы он переживал перезапуск бота
+RESPONSE_CACHE_PERSIST = False
+# Кэшируются только запросы не длиннее стольких сообщений (1 - только первый ход диалога, 0 - без ограничения)
+RESPONSE_CACHE_MAX_MESSAGES = 1
+# Сколько секунд одинаковый запрос ждёт уже выполняющийся, прежде чем отправить свой
+RESPONSE_CACHE_WAIT_TIMEOUT = 180
+
+# Текст сообщения длиннее стольких байт хранится сжатым (zlib)
+MESSAGE_COMPRESS_THRESHOLD = 512
+# Хранение истории: сообщения старше стольких дней и сверх стольких последних у пользователя удаляются (0 - без ограничения)
+MESSAGE_RETENTION_DAYS = 0
+MESSAGE_RETENTION_COUNT = 0
+# Как часто (в секундах) выполняется очистка и сколько строк удаляется за одну транзакцию
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH_SIZE = 1000
+# Сколько свободных страниц возвращается файловой системе за проход (PRAGMA incremental_vacuum; 0 - все)
+RETENTION_VACUUM_PAGES = 0
+
+# Бюджет времени запуска (секунды): от импорта main.py до готовности к приёму обновлений.
+# Превышение пишется в лог; python -m benchmarks.startup проверяет импорт и init_db() отдельно
+STARTUP_TIME_BUDGET = 2.0
+
+# PRAGMA, применяемые к каждому соединению SQLite
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # читатели не блокируют писателя
+    'synchronous': 'NORMAL',  # в режиме WAL безопасно и без fsync на каждый коммит
+    'busy_timeout': 5000,  # мс ожидания блокировки вместо немедленной ошибки
+    'cache_size': -20000,  # ~20 МБ страничного кэша
+    'temp_store': 'MEMORY',
+}
+
+# Список доступных моделей для выбора
+AVAILABLE_MODELS = {
+    1: {"name": "openrouter/auto", "max_tokens": 128000},
+    2: {"name": "nousresearch/nous-capybara-7b", "max_tokens": 4096},
+    3: {"name": "mistralai/mistral-7b-instruct", "max_tokens": 8192},
+    4: {"name": "huggingfaceh4/zephyr-7b-beta", "max_tokens": 4096},
+    5: {"name": "openchat/openchat-7b", "max_tokens": 8192},
+    6: {"name": "gryphe/mythomist-7b", "max_tokens": 32768},
+    7: {"name": "openrouter/cinematika-7b", "max_tokens": 8000},
+    8: {"name": "rwkv/rwkv-5-world-3b", "max_tokens": 10000},
+    9: {"name": "recursal/rwkv-5-3b-ai-town", "max_tokens": 10000},
+    10: {"name": "recursal/eagle-7b", "max_tokens": 10000},
+    11: {"name": "jondurbin/bagel-34b", "max_tokens": 8000},
+    12: {"name": "jebcarter/psyfighter-13b", "max_tokens": 4096},
+    13: {"name": "koboldai/psyfighter-13b-2", "max_tokens": 4096},
+    14: {"name": "neversleep/noromaid-mixtral-8x7b-instruct", "max_tokens": 8000},
+    15: {"name": "nousresearch/nous-hermes-llama2-13b", "max_tokens": 4096},
+    16: {"name": "meta-llama/codellama-34b-instruct", "max_tokens": 8192},
+    17: {"name": "phind/phind-codellama-34b", "max_tokens": 4096},
+    18: {"name": "intel/neural-chat-7b", "max_tokens": 4096},
+    19: {"name": "nousresearch/nous-hermes-2-mixtral-8x7b-dpo", "max_tokens": 32000},
+    20: {"name": "nousresearch/nous-hermes-2-mixtral-8x7b-sft", "max_tokens": 32000},
+    21: {"name": "haotian-liu/llava-13b", "max_tokens": 2048},
+    22: {"name": "nousresearch/nous-hermes-2-vision-7b", "max_tokens": 4096},
+    23: {"name": "meta-llama/llama-2-13b-chat", "max_tokens": 4096},
+    24: {"name": "gryphe/mythomax-l2-13b", "max_tokens": 4096},
+    25: {"name": "nousresearch/nous-hermes-llama2-70b", "max_tokens": 4096},
+    26: {"name": "teknium/openhermes-2-mistral-7b", "max_tokens": 4096},
+    27: {"name": "teknium/openhermes-2.5-mistral-7b", "max_tokens": 4096},
+    28: {"name": "undi95/remm-slerp-l2-13b", "max_tokens": 4096},
+    29: {"name": "undi95/toppy-m-7b", "max_tokens": 4096},
+    30: {"name": "01-ai/yi-34b-chat", "max_tokens": 4096},
+    31: {"name": "01-ai/yi-6b", "max_tokens": 4096},
+    32: {"name": "togethercomputer/stripedhyena-nous-7b", "max_tokens": 32768},
+    33: {"name": "togethercomputer/stripedhyena-hessian-7b", "max_tokens": 32768},
+    34: {"name": "mistralai/mixtral-8x7b", "max_tokens": 32768},
+    35: {"name": "nousresearch/nous-hermes-yi-34b", "max_tokens": 4096},
+    36: {"name": "open-orca/mistral-7b-openorca", "max_tokens": 8192},
+    37: {"name": "openai/gpt-3.5-turbo", "max_tokens": 4095},
+    38: {"name": "openai/gpt-3.5-turbo-16k", "max_tokens": 16385},
+    39: {"name": "openai/gpt-4-turbo-preview", "max_tokens": 128000},
+    40: {"name": "openai/gpt-4", "max_tokens": 8191},
+    41: {"name": "openai/gpt-4-32k", "max_tokens": 32767},
+    42: {"name": "openai/gpt-4-vision-preview", "max_tokens": 128000},
+    43: {"name": "openai/gpt-3.5-turbo-instruct", "max_tokens": 4095},
+    44: {"name": "google/palm-2-chat-bison", "max_tokens": 36864},
+    45: {"name": "google/palm-2-codechat-bison", "max_tokens": 28672},
+    46: {"name": "google/palm-2-chat-bison-32k", "max_tokens": 131072},
+    47: {"name": "google/palm-2-codechat-bison-32k", "max_tokens": 131072},
+    48: {"name": "google/gemini-pro", "max_tokens": 131040},
+    49: {"name": "google/gemini-pro-vision", "max_tokens": 65536},
+    50: {"name": "perplexity/pplx-70b-online", "max_tokens": 4096},
+    51: {"name": "perplexity/pplx-7b-online", "max_tokens": 4096},
+    52: {"name": "perplexity/pplx-7b-chat", "max_tokens": 8192},
+    53: {"name": "perplexity/pplx-70b-chat", "max_tokens": 4096},
+    54: {"name": "meta-llama/llama-2-70b-chat", "max_tokens": 4096},
+    55: {"name": "nousresearch/nous-capybara-34b", "max_tokens": 32768},
+    56: {"name": "jondurbin/airoboros-l2-70b", "max_tokens": 4096},
+    57: {"name": "austism/chronos-hermes-13b", "max_tokens": 4096},
+    58: {"name": "migtissera/synthia-70b", "max_tokens": 8192},
+    59: {"name": "pygmalionai/mythalion-13b", "max_tokens": 8192},
+    60: {"name": "undi95/remm-slerp-l2-13b-6k", "max_tokens": 6144},
+    61: {"name": "xwin-lm/xwin-lm-70b", "max_tokens": 8192},
+    62: {"name": "gryphe/mythomax-l2-13b-8k", "max_tokens": 8192},
+    63: {"name": "alpindale/goliath-120b", "max_tokens": 6144},
+    64: {"name": "lizpreciatior/lzlv-70b-fp16-hf", "max_tokens": 4096},
+    65: {"name": "neversleep/noromaid-20b", "max_tokens": 8192},
+    66: {"name": "mistralai/mixtral-8x7b-instruct", "max_tokens": 32768},
+    67: {"name": "cognitivecomputations/dolphin-mixtral-8x7b", "max_tokens": 32000},
+    68: {"name": "anthropic/claude-2", "max_tokens": 200000},
+    69: {"name": "anthropic/claude-2.0", "max_tokens": 100000},
+    70: {"name": "anthropic/claude-instant-v1", "max_tokens": 100000},
+    71: {"name": "mancer/weaver", "max_tokens": 8000},
+    72: {"name": "mistralai/mistral-tiny", "max_tokens": 32000},
+    73: {"name": "mistralai/mistral-small", "max_tokens": 32000},
+    74: {"name": "mistralai/mistral-medium", "max_tokens": 32000},
+}
+
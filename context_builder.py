@@ -0,0 +1,143 @@
+#context_builder.py
+# Сборка истории диалога в пределах бюджета токенов модели
+import logging
+import math
+from sqlalchemy.orm import Session
+from config import (AVAILABLE_MODELS, MAX_HISTORY_TOKENS, CONTEXT_REPLY_RESERVE, CONTEXT_SUMMARY,
+                    CONTEXT_SUMMARY_TOKENS, CONTEXT_SUMMARY_MIN_TOKENS)
+from db import iter_recent_messages, iter_messages_after, update_user_summary, message_writer
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены, которые модель тратит на разметку каждого сообщения
+MESSAGE_TOKEN_OVERHEAD = 4
+ROLE_MAPPING = {'in': 'user', 'out': 'assistant'}
+# Размер контекстного окна по имени модели
+MODEL_CONTEXT_WINDOWS = {model['name']: model['max_tokens'] for model in AVAILABLE_MODELS.values()}
+
+SUMMARY_PROMPT = ("Кратко перескажи содержание диалога ниже, сохранив факты, договорённости и "
+                  "контекст, важные для продолжения разговора. Ответь только пересказом.\n\n")
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: около четырёх байт UTF-8 на токен плюс разметка сообщения."""
+    return math.ceil(len(text.encode('utf-8')) / 4) + MESSAGE_TOKEN_OVERHEAD
+
+
+def _context_window(model_id: str, max_tokens: int = None) -> int:
+    return MODEL_CONTEXT_WINDOWS.get(model_id) or max_tokens or 4096
+
+
+def reply_reserve(model_id: str, max_tokens: int = None) -> int:
+    """Токены, оставляемые под ответ; это же значение отправляется в запросе как max_tokens."""
+    window = _context_window(model_id, max_tokens)
+    return min(max_tokens or window, int(window * CONTEXT_REPLY_RESERVE))
+
+
+def context_budget(model_id: str, max_tokens: int = None) -> int:
+    """Число токенов, доступное под историю: окно модели за вычетом резерва под ответ."""
+    budget = _context_window(model_id, max_tokens) - reply_reserve(model_id, max_tokens)
+    if MAX_HISTORY_TOKENS:
+        budget = min(budget, MAX_HISTORY_TOKENS)
+    return budget
+
+
+def message_tokens(message) -> int:
+    # Для строк, записанных до появления token_count, оценка считается на лету
+    return message.token_count or estimate_tokens(message.text)
+
+
+def build_context(db_user, prompt: str, session: Session, summarize=None) -> list:
+    """Собирает историю от новых сообщений к старым, пока она помещается в бюджет.
+
+    Если включён CONTEXT_SUMMARY и передана функция summarize(text) -> str, отброшенное начало
+    диалога заменяется кратким содержанием, которое обновляется инкрементально.
+    """
+    # Предыдущий ход мог ещё не дойти до базы из очереди отложенной записи
+    message_writer.sync_user(db_user.id)
+    budget = context_budget(db_user.model_id, db_user.max_tokens) - estimate_tokens(prompt)
+    use_summary = CONTEXT_SUMMARY and summarize is not None
+    if use_summary:
+        budget -= CONTEXT_SUMMARY_TOKENS + MESSAGE_TOKEN_OVERHEAD
+
+    selected = []
+    oldest_kept_id = None
+    truncated = False
+    for message in iter_recent_messages(db_user.id, session):
+        tokens = message_tokens(message)
+        if tokens > budget:
+            truncated = True
+            break
+        budget -= tokens
+        selected.append({"role": ROLE_MAPPING.get(message.direction, 'assistant'), "content": message.text})
+        oldest_kept_id = message.id
+    selected.reverse()
+
+    if use_summary and truncated:
+        summary = rolling_summary(db_user, oldest_kept_id, session, summarize)
+        if summary:
+            selected.insert(0, {"role": "system",
+                                "content": f"Краткое содержание предыдущей части диалога: {summary}"})
+    return selected
+
+
+def fit_context(history: list, prompt: str, model_id: str, max_tokens: int = None) -> list:
+    """Обрезает собранную для другой модели историю под окно model_id, отбрасывая самые старые сообщения.
+
+    Краткое содержание в начале истории сохраняется, если помещается в бюджет.
+    """
+    budget = context_budget(model_id, max_tokens) - estimate_tokens(prompt)
+    summary = history[:1] if history and history[0]['role'] == 'system' else []
+    messages = history[len(summary):]
+    if summary:
+        summary_tokens = estimate_tokens(summary[0]['content'])
+        if summary_tokens <= budget:
+            budget -= summary_tokens
+        else:
+            summary = []
+    kept = []
+    for message in reversed(messages):
+        tokens = estimate_tokens(message['content'])
+        if tokens > budget:
+            break
+        budget -= tokens
+        kept.append(message)
+    kept.reverse()
+    return summary + kept
+
+
+def rolling_summary(db_user, oldest_kept_id: int, session: Session, summarize):
+    """Дополняет сохранённое краткое содержание сообщениями, выпавшими из окна с прошлого раза.
+
+    Сообщения берутся от старых к новым, начиная сразу после summary_upto, и только пока помещаются
+    в бюджет; summary_upto сдвигается лишь за вошедшие в пересказ, поэтому большой хвост
+    отброшенной истории догоняется за несколько ходов без пропусков.
+    """
+    pending = []
+    pending_tokens = 0
+    limit = context_budget(db_user.model_id, db_user.max_tokens)
+    for message in iter_messages_after(db_user.id, session, after_id=db_user.summary_upto,
+                                       before_id=oldest_kept_id):
+        tokens = message_tokens(message)
+        if pending and pending_tokens + tokens > limit:
+            break
+        # Сообщение больше всего бюджета берётся одно, иначе пересказ навсегда остановился бы на нём
+        pending.append(message)
+        pending_tokens += tokens
+        if pending_tokens >= limit:
+            break
+
+    if pending_tokens < CONTEXT_SUMMARY_MIN_TOKENS:
+        return db_user.context_summary
+
+    max_chars = limit * 4
+    transcript = "\n".join(f"{ROLE_MAPPING.get(message.direction, 'assistant')}: {message.text[:max_chars]}"
+                           for message in pending)
+    if db_user.context_summary:
+        transcript = f"Краткое содержание ранее: {db_user.context_summary}\n\n{transcript}"
+    summary = summarize(SUMMARY_PROMPT + transcript)
+    if not summary:
+        logger.warning("Failed to update context summary for user %s", db_user.telegram_id)
+        return db_user.context_summary
+    update_user_summary(db_user.telegram_id, summary, pending[-1].id, session)
+    return summary
@@ -1,14 +1,111 @@
-from sqlalchemy import create_engine
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+from sqlalchemy import create_engine, event, func, inspect, text
 from sqlalchemy.orm import sessionmaker, Session as BaseSession
-from models import Base, User, Message
-from config import DATABASE_URL
+from models import Base, User, Message, CachedResponse
+from cache import TTLCache
+from metrics import timed
+from writer import MessageWriter
+from config import (DATABASE_URL, HISTORY_PAGE_SIZE, USER_CACHE_SIZE, USER_CACHE_TTL, MESSAGE_BATCH_SIZE,
+                    MESSAGE_FLUSH_INTERVAL, SQLITE_PRAGMAS, SQL_ECHO, UPDATE_MODE, WEBHOOK_WORKERS,
+                    WEBHOOK_USER_CACHE_TTL)
 
-engine = create_engine(DATABASE_URL, echo=True)
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+logger = logging.getLogger(__name__)
+
+# Единственный движок процесса; создаётся при первом обращении, импорт модуля базу не открывает
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = create_engine(DATABASE_URL, echo=SQL_ECHO)
+                if engine.dialect.name == 'sqlite':
+                    event.listen(engine, "connect", _set_sqlite_pragmas)
+                _engine = engine
+    return _engine
+
+def SessionLocal() -> BaseSession:
+    # Фабрика сессий с прежним именем: движок создаётся при открытии первой сессии
+    return _session_factory(bind=get_engine())
+
+def dispose_engine():
+    # Перед fork: процессы-обработчики не должны наследовать открытые соединения
+    if _engine is not None:
+        _engine.dispose()
+
+# Пакетная запись новых сообщений; запускается в main(), до запуска пишет синхронно
+message_writer = MessageWriter(SessionLocal, batch_size=MESSAGE_BATCH_SIZE, flush_interval=MESSAGE_FLUSH_INTERVAL)
+
+class UserProfile(NamedTuple):
+    # Неизменяемый снимок строки users, который можно безопасно разделять между потоками
+    id: int
+    telegram_id: int
+    api_key: Optional[str]
+    model_id: Optional[str]
+    max_tokens: Optional[int]
+    is_valid: bool
+    context_summary: Optional[str]
+    summary_upto: Optional[int]
+    awaiting_model_choice: bool
+    fallback_model_id: Optional[str]
+
+    @classmethod
+    def from_user(cls, user: User) -> 'UserProfile':
+        return cls(user.id, user.telegram_id, user.api_key, user.model_id, user.max_tokens,
+                   bool(user.is_valid), user.context_summary, user.summary_upto, bool(user.awaiting_model_choice),
+                   user.fallback_model_id)
+
+# Профили по Telegram ID; сбрасываются при каждой записи в users. Сброс действует только в своём
+# процессе, поэтому при нескольких процессах webhook профиль хранится лишь пару секунд
+user_profiles = TTLCache(USER_CACHE_SIZE, WEBHOOK_USER_CACHE_TTL if UPDATE_MODE == 'webhook' and WEBHOOK_WORKERS > 1
+                         else USER_CACHE_TTL)
+# Номер поколения профиля растёт при каждом сбросе: снимок, прочитанный до сброса, не попадёт в кэш
+_profile_generations = {}
+_profile_lock = threading.Lock()
 
 def get_user_by_telegram_id(telegram_id: int, session: BaseSession):
     return session.query(User).filter(User.telegram_id == telegram_id).first()
 
+def get_user_profile(telegram_id: int, session: BaseSession = None) -> Optional[UserProfile]:
+    profile = user_profiles.get(telegram_id)
+    if profile is not None:
+        return profile
+    if session is None:
+        with SessionLocal() as session:
+            return _load_user_profile(telegram_id, session)
+    return _load_user_profile(telegram_id, session)
+
+def _load_user_profile(telegram_id: int, session: BaseSession) -> Optional[UserProfile]:
+    generation = _profile_generations.get(telegram_id, 0)
+    with timed('db_profile'):
+        user = get_user_by_telegram_id(telegram_id, session)
+    if user is None:
+        return None
+    profile = UserProfile.from_user(user)
+    with _profile_lock:
+        # Пока строка читалась, её могли изменить и сбросить кэш; такой снимок возвращается, но не кэшируется
+        if _profile_generations.get(telegram_id, 0) == generation:
+            user_profiles.set(telegram_id, profile)
+    return profile
+
+def invalidate_user_profile(telegram_id: int):
+    with _profile_lock:
+        _profile_generations[telegram_id] = _profile_generations.get(telegram_id, 0) + 1
+        user_profiles.invalidate(telegram_id)
+
 def create_or_update_user(telegram_id: int, api_key: str, session: BaseSession):
     user = get_user_by_telegram_id(telegram_id, session)
     if user is None:
@@ -17,6 +114,7 @@ def create_or_update_user(telegram_id: int, api_key: str, session: BaseSession):
     else:
         user.api_key = api_key
     session.commit()
+    invalidate_user_profile(telegram_id)
     return user
 
 def update_user_api_key(telegram_id: int, api_key: str, session: BaseSession):
@@ -24,6 +122,7 @@ def update_user_api_key(telegram_id: int, api_key: str, session: BaseSession):
     if user:
         user.api_key = api_key
         session.commit()
+        invalidate_user_profile(telegram_id)
 
 def update_user_model(telegram_id: int, model_id: str, max_tokens: int, session: BaseSession):
     user = get_user_by_telegram_id(telegram_id, session)
@@ -31,19 +130,249 @@ def update_user_model(telegram_id: int, model_id: str, max_tokens: int, session:
         user.model_id = model_id
         user.max_tokens = max_tokens
         session.commit()
+        invalidate_user_profile(telegram_id)
+
+def update_user_fallback_model(telegram_id: int, fallback_model_id: Optional[str], session: BaseSession):
+    user = get_user_by_telegram_id(telegram_id, session)
+    if user:
+        user.fallback_model_id = fallback_model_id
+        session.commit()
+        invalidate_user_profile(telegram_id)
+
+def set_awaiting_model_choice(telegram_id: int, awaiting: bool, session: BaseSession):
+    # Состояние диалога хранится в базе, а не в context.user_data: его видят все процессы-обработчики
+    user = get_user_by_telegram_id(telegram_id, session)
+    if user:
+        user.awaiting_model_choice = awaiting
+        session.commit()
+        invalidate_user_profile(telegram_id)
 
-def add_message(user_id: int, text: str, timestamp: str, direction: str, session: BaseSession):
-    new_message = Message(user_id=user_id, text=text, timestamp=timestamp, direction=direction)
+def mark_api_key_invalid(api_key: str, session: BaseSession):
+    # Помечает ключ недействительным у всех пользователей, которые его используют
+    users = session.query(User).filter(User.api_key == api_key, User.is_valid.is_(True)).all()
+    for user in users:
+        user.is_valid = False
+    session.commit()
+    telegram_ids = [user.telegram_id for user in users]
+    for telegram_id in telegram_ids:
+        invalidate_user_profile(telegram_id)
+    return telegram_ids
+
+def update_user_summary(telegram_id: int, summary: str, summary_upto: int, session: BaseSession):
+    user = get_user_by_telegram_id(telegram_id, session)
+    if user:
+        user.context_summary = summary
+        user.summary_upto = summary_upto
+        session.commit()
+        invalidate_user_profile(telegram_id)
+
+def add_message(user_id: int, text: str, timestamp: datetime, direction: str, session: BaseSession, token_count: int = None):
+    new_message = Message(user_id=user_id, text=text, timestamp=timestamp, direction=direction, token_count=token_count)
     session.add(new_message)
     session.commit()
     return new_message
 
-def get_user_messages(user_id: int, session: BaseSession):
-    return session.query(Message).filter(Message.user_id == user_id).all()
+# Столбцы, которых достаточно для сборки контекста; timestamp и связи не загружаются
+HISTORY_COLUMNS = (Message.id, Message.direction, Message.text, Message.token_count)
+
+def get_user_messages(user_id: int, session: BaseSession, limit: int = None):
+    # Последние limit сообщений (или вся история) в хронологическом порядке
+    rows = get_recent_messages(user_id, session, limit=limit)
+    rows.reverse()
+    return rows
+
+def get_recent_messages(user_id: int, session: BaseSession, limit: int = HISTORY_PAGE_SIZE,
+                        before_id: int = None, after_id: int = None):
+    # ORDER BY id DESC LIMIT n по индексу (user_id, id); before_id - курсор предыдущей страницы
+    query = session.query(*HISTORY_COLUMNS).filter(Message.user_id == user_id)
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+    if after_id is not None:
+        query = query.filter(Message.id > after_id)
+    query = query.order_by(Message.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+def get_message_page(user_id: int, session: BaseSession, cursor: int = None, limit: int = HISTORY_PAGE_SIZE):
+    # Страница истории от новых к старым и курсор следующей страницы (None, если история закончилась)
+    rows = get_recent_messages(user_id, session, limit=limit, before_id=cursor)
+    next_cursor = rows[-1].id if len(rows) == limit else None
+    return rows, next_cursor
+
+def iter_recent_messages(user_id: int, session: BaseSession, before_id: int = None, after_id: int = None,
+                         page_size: int = HISTORY_PAGE_SIZE):
+    # Сообщения от новых к старым; страницы подгружаются по мере необходимости
+    cursor = before_id
+    while True:
+        rows = get_recent_messages(user_id, session, limit=page_size, before_id=cursor, after_id=after_id)
+        yield from rows
+        if len(rows) < page_size:
+            return
+        cursor = rows[-1].id
+
+def iter_messages_after(user_id: int, session: BaseSession, after_id: int = None, before_id: int = None,
+                        page_size: int = HISTORY_PAGE_SIZE):
+    # Сообщения от старых к новым в интервале (after_id, before_id); страницы подгружаются по мере необходимости
+    cursor = after_id
+    while True:
+        query = session.query(*HISTORY_COLUMNS).filter(Message.user_id == user_id)
+        if cursor is not None:
+            query = query.filter(Message.id > cursor)
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        rows = query.order_by(Message.id.asc()).limit(page_size).all()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        cursor = rows[-1].id
 
 def delete_user_messages(user_id: int, session: BaseSession):
+    # Иначе сообщения из очереди записи появились бы уже после удаления
+    message_writer.sync_user(user_id)
     session.query(Message).filter(Message.user_id == user_id).delete()
     session.commit()
 
-if __name__ == "__main__":
+def get_cached_response(key: str, max_age: float, session: BaseSession):
+    # (ответ, время создания) или None, если ответа нет или он устарел
+    row = session.query(CachedResponse.response, CachedResponse.created_at).filter(
+        CachedResponse.key == key, CachedResponse.created_at >= int(time.time() - max_age)).first()
+    return tuple(row) if row else None
+
+def save_cached_response(key: str, response: str, session: BaseSession):
+    session.merge(CachedResponse(key=key, response=response, created_at=int(time.time())))
+    session.commit()
+
+def purge_cached_responses(max_age: float, session: BaseSession) -> int:
+    deleted = session.query(CachedResponse).filter(CachedResponse.created_at < int(time.time() - max_age)).delete()
+    session.commit()
+    return deleted
+
+def prune_old_messages(cutoff: datetime, session: BaseSession, batch_size: int) -> int:
+    # id растёт вместе со временем, поэтому старые строки находятся в начале таблицы без индекса по timestamp
+    ids = [row.id for row in session.query(Message.id).filter(Message.timestamp < cutoff)
+           .order_by(Message.id).limit(batch_size)]
+    if ids:
+        session.query(Message).filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+    return len(ids)
+
+def prune_excess_messages(keep: int, session: BaseSession) -> int:
+    # У каждого пользователя остаются только keep последних сообщений
+    deleted = 0
+    user_ids = [row.user_id for row in session.query(Message.user_id).group_by(Message.user_id)
+                .having(func.count(Message.id) > keep)]
+    for user_id in user_ids:
+        boundary = (session.query(Message.id).filter(Message.user_id == user_id)
+                    .order_by(Message.id.desc()).offset(keep - 1).limit(1).scalar())
+        deleted += session.query(Message).filter(Message.user_id == user_id, Message.id < boundary) \
+            .delete(synchronize_session=False)
+        session.commit()
+    return deleted
+
+def incremental_vacuum(engine, pages: int = 0):
+    # Возвращает файловой системе свободные страницы, оставшиеся после удаления строк
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.connect() as connection:
+        # execute() модуля sqlite3 делает один шаг PRAGMA (одна страница), executescript() выполняет её полностью
+        pragma = f'PRAGMA incremental_vacuum({pages})' if pages else 'PRAGMA incremental_vacuum'
+        connection.connection.executescript(pragma)
+
+def _link_messages_to_users(connection):
+    # Раньше в messages.user_id записывался Telegram ID вместо users.id
+    connection.execute(text(
+        'UPDATE messages SET user_id = (SELECT users.id FROM users WHERE users.telegram_id = messages.user_id) '
+        'WHERE user_id IN (SELECT telegram_id FROM users)'
+    ))
+
+# Сколько строк переносится за один шаг миграции
+MIGRATION_BATCH_SIZE = 5000
+
+def _legacy_timestamp(value):
+    # Раньше в timestamp записывался str(datetime.now())
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return 0
+
+def _compact_messages(connection):
+    # SQLite не меняет тип существующего столбца: таблица messages пересоздаётся по новой схеме
+    # (timestamp - Unix time, direction - число, длинный текст сжат), строки переносятся пачками
+    columns = {row[1]: row[2] for row in connection.execute(text('PRAGMA table_info(messages)'))}
+    if columns.get('timestamp', '').upper() == 'INTEGER':
+        return
+    logger.info("Converting the messages table to the compact format")
+    connection.execute(text('ALTER TABLE messages RENAME TO messages_legacy'))
+    legacy_indexes = connection.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'messages_legacy' AND sql IS NOT NULL"
+    )).fetchall()
+    for (name,) in legacy_indexes:
+        connection.execute(text(f'DROP INDEX {name}'))
+    Message.__table__.create(connection)
+
+    last_id = 0
+    while True:
+        rows = connection.execute(text(
+            'SELECT id, user_id, text, timestamp, direction, token_count FROM messages_legacy '
+            'WHERE id > :last_id ORDER BY id LIMIT :limit'
+        ), {'last_id': last_id, 'limit': MIGRATION_BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+        connection.execute(Message.__table__.insert(), [
+            dict(id=row.id, user_id=row.user_id, text=row.text, timestamp=_legacy_timestamp(row.timestamp),
+                 direction=row.direction, token_count=row.token_count)
+            for row in rows
+        ])
+        last_id = rows[-1].id
+    connection.execute(text('DROP TABLE messages_legacy'))
+
+def _enable_incremental_vacuum(engine):
+    # auto_vacuum вступает в силу только после полного VACUUM, а его нельзя выполнить внутри транзакции
+    with engine.connect() as connection:
+        if connection.execute(text('PRAGMA auto_vacuum')).scalar() == 2:
+            return
+        logger.info("Enabling incremental auto_vacuum, running a one-time VACUUM")
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+        connection.execute(text('VACUUM'))
+
+# Версионные миграции данных: (номер версии, функция). Текущая версия хранится в PRAGMA user_version
+DATA_MIGRATIONS = [
+    (1, _link_messages_to_users),
+    (2, _compact_messages),
+]
+
+def migrate_schema(engine):
+    # create_all не изменяет существующие таблицы, поэтому недостающие столбцы и индексы добавляются вручную
     Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+        version = connection.execute(text('PRAGMA user_version')).scalar()
+        for target_version, migration in DATA_MIGRATIONS:
+            if version < target_version:
+                migration(connection)
+                connection.execute(text(f'PRAGMA user_version = {target_version}'))
+                version = target_version
+
+    if engine.dialect.name == 'sqlite':
+        _enable_incremental_vacuum(engine)
+
+def init_db():
+    """Создаёт недостающие таблицы и применяет миграции; вызывается один раз при запуске, не при импорте."""
+    engine = get_engine()
+    with timed('db_init'):
+        migrate_schema(engine)
+    return engine
+
+if __name__ == "__main__":
+    init_db()
@@ -0,0 +1,124 @@
+#hedging.py
+# Страховочные (hedged) запросы к резервной модели при медленном или недоступном основном ответе
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from metrics import upstream_hedges_total, upstream_hedge_wins_total
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых имеет смысл сразу спросить резервную модель; 400/401/402/403 она не исправит
+FALLBACK_STATUSES = {404, 408, 429}
+
+
+class LatencyTracker:
+    """Время до первого фрагмента ответа последних window запросов к каждой модели."""
+
+    def __init__(self, window: int = 200):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def observe(self, model_id: str, seconds: float):
+        with self._lock:
+            self._samples[model_id].append(seconds)
+
+    def percentile(self, model_id: str, q: float, min_samples: int = 1):
+        """Квантиль q по последним наблюдениям или None, если наблюдений меньше min_samples."""
+        with self._lock:
+            samples = sorted(self._samples.get(model_id, ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def should_fall_back(error: Exception) -> bool:
+    response = getattr(error, 'response', None)
+    if response is None:
+        # Ошибки соединения, таймауты, разомкнутый автомат модели, ошибка внутри потока
+        return True
+    return response.status_code >= 500 or response.status_code in FALLBACK_STATUSES
+
+
+def _pump(name: str, open_stream, events: queue.Queue, cancelled: threading.Event):
+    chunks = open_stream()
+    try:
+        for chunk in chunks:
+            if cancelled.is_set():
+                return
+            events.put((name, 'chunk', chunk))
+        events.put((name, 'done', None))
+    except Exception as e:
+        events.put((name, 'error', e))
+    finally:
+        # Закрытие генератора закрывает HTTP-ответ проигравшего запроса
+        chunks.close()
+
+
+def hedged_stream(open_primary, open_fallback, delay: float):
+    """Генератор фрагментов ответа основной модели со страховкой резервной.
+
+    Если основная модель не прислала первый фрагмент за delay секунд или завершилась ошибкой,
+    после которой есть смысл спросить другую модель, запускается запрос к резервной. Ответ
+    берётся у той модели, которая первой прислала фрагмент; второй запрос отменяется при
+    получении им следующего фрагмента. Ошибка пробрасывается, только если не удалось получить
+    ответ ни от одной модели.
+    """
+    events = queue.Queue()
+    cancel = {'primary': threading.Event(), 'fallback': threading.Event()}
+    running = set()
+    winner = None
+    last_error = None
+
+    def launch(name, open_stream):
+        running.add(name)
+        threading.Thread(target=_pump, args=(name, open_stream, events, cancel[name]),
+                         name=f'hedge-{name}', daemon=True).start()
+
+    def hedge(reason):
+        upstream_hedges_total.inc(reason=reason)
+        launch('fallback', open_fallback)
+
+    launch('primary', open_primary)
+    hedged = False
+    deadline = time.monotonic() + delay
+    try:
+        while True:
+            # Ждём первый фрагмент основной модели не дольше delay, дальше - без ограничения
+            timeout = None if hedged or winner is not None else max(0.0, deadline - time.monotonic())
+            try:
+                name, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                hedged = True
+                hedge('slow')
+                continue
+            if winner is not None and name != winner:
+                continue
+            if kind == 'chunk':
+                if winner is None:
+                    winner = name
+                    upstream_hedge_wins_total.inc(winner=name)
+                    for other, event in cancel.items():
+                        if other != name:
+                            event.set()
+                yield value
+                continue
+            running.discard(name)
+            if winner == name:
+                if kind == 'error':
+                    raise value
+                return
+            if kind == 'error':
+                last_error = value
+                logger.warning("Hedged %s request failed: %s", name, value)
+                if not hedged and should_fall_back(value):
+                    hedged = True
+                    hedge('error')
+            if not running:
+                if last_error is not None:
+                    raise last_error
+                return
+    finally:
+        for event in cancel.values():
+            event.set()
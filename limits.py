@@ -0,0 +1,152 @@
+#limits.py
+# Ограничение частоты запросов (token bucket) и справедливая очередь к OpenRouter
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from cache import TTLCache
+
+
+class RateLimitExceeded(Exception):
+    """Жетонов не осталось; retry_after - через сколько секунд запрос будет разрешён."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f'rate limit exceeded, retry after {retry_after:.1f} s')
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Ведро на capacity жетонов, пополняется со скоростью rate жетонов в секунду."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, cost: float = 1) -> bool:
+        self._refill(time.monotonic())
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def retry_after(self, cost: float = 1) -> float:
+        # Через сколько секунд в ведре снова наберётся cost жетонов
+        self._refill(time.monotonic())
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Отдельное ведро для каждого ключа (пользователя, модели).
+
+    Ведро, которое не использовалось дольше времени полного пополнения, всё равно было бы
+    полным, поэтому такие вёдра вытесняются из кэша без изменения поведения. rate <= 0
+    отключает ограничение.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 100000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._buckets = TTLCache(maxsize, self.burst / rate if rate > 0 else 0)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, key, cost: float = 1):
+        """Списывает жетон; возвращает 0, если запрос разрешён, иначе время ожидания в секундах."""
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+            allowed = bucket.try_acquire(cost)
+            # Повторная запись продлевает время жизни активного ведра
+            self._buckets.set(key, bucket)
+            return 0.0 if allowed else max(bucket.retry_after(cost), 1e-3)
+
+
+class FairSemaphore:
+    """Ограничивает число одновременных запросов; при нехватке мест обслуживает пользователей по кругу.
+
+    Освободившееся место получает следующий по очереди пользователь, а не следующий запрос,
+    поэтому пользователь с десятком ожидающих запросов не задерживает тех, у кого запрос один.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit  # 0 - без ограничения
+        self.active = 0
+        self._waiters = {}  # пользователь -> deque событий ожидающих запросов
+        self._rotation = deque()  # пользователи с ожидающими запросами, в порядке обслуживания
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+    def acquire(self, key):
+        with self._lock:
+            if self.limit <= 0 or (self.active < self.limit and not self._rotation):
+                self.active += 1
+                return
+            granted = threading.Event()
+            waiters = self._waiters.get(key)
+            if waiters is None:
+                waiters = self._waiters[key] = deque()
+                self._rotation.append(key)
+            waiters.append(granted)
+        granted.wait()
+
+    def release(self):
+        with self._lock:
+            if not self._rotation:
+                self.active -= 1
+                return
+            # Место переходит к следующему пользователю без уменьшения active
+            key = self._rotation.popleft()
+            waiters = self._waiters[key]
+            granted = waiters.popleft()
+            if waiters:
+                self._rotation.append(key)
+            else:
+                del self._waiters[key]
+            granted.set()
+
+    @contextmanager
+    def slot(self, key):
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Pacer:
+    """Планирует отправки не чаще rate в секунду с запасом burst (алгоритм GCRA).
+
+    В отличие от TokenBucket не отказывает, а называет момент, когда отправка разрешена,
+    и резервирует его: параллельные отправители выстраиваются один за другим.
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.interval = 1 / rate
+        self.tolerance = (max(1, burst) - 1) * self.interval
+        self.tat = 0.0  # теоретическое время следующей отправки
+        self.blocked_until = 0.0  # Telegram попросил подождать (retry_after)
+
+    def earliest(self, now: float) -> float:
+        return max(now, self.tat - self.tolerance, self.blocked_until)
+
+    def commit(self, at: float):
+        self.tat = max(self.tat, at) + self.interval
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
@@ -1,20 +1,149 @@
 #log_config.py
+import atexit
+import hashlib
+import json
 import logging
-from config import LOG_FILE
+import os
+import queue
+import random
+import re
+from logging.handlers import QueueHandler, QueueListener
+from config import (LOG_FILE, LOG_LEVEL, LOG_QUEUE_SIZE, LOG_VERBOSE_SAMPLE_RATE, LOG_BODY_PREVIEW,
+                    LOG_MAX_MESSAGE_LENGTH)
+
+# Ключи OpenRouter (sk-or-...) и любые Bearer-токены
+SECRET_PATTERN = re.compile(r'(sk-[A-Za-z0-9_-]{8,}|Bearer\s+[^\s\'",}]+)')
+
+_listener = None
+
+
+def redact(text: str) -> str:
+    return SECRET_PATTERN.sub('[REDACTED]', text)
+
+
+class CompactBody:
+    """Ленивое компактное представление запроса или ответа для логов.
+
+    Строки длиннее LOG_BODY_PREVIEW заменяются началом и хэшем. Вычисляется только при
+    форматировании записи, то есть в потоке записи логов, а не в обработчике сообщения.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def __str__(self):
+        return json.dumps(self._compact(self.body), ensure_ascii=False)
+
+    def _compact(self, value):
+        if isinstance(value, dict):
+            return {key: self._compact(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._compact(item) for item in value]
+        if isinstance(value, str) and len(value) > LOG_BODY_PREVIEW:
+            digest = hashlib.sha256(value.encode('utf-8')).hexdigest()[:12]
+            return f"{value[:LOG_BODY_PREVIEW]}... [{len(value)} chars, sha256:{digest}]"
+        return value
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает лишь долю записей, помеченных extra={'verbose': True}."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, 'verbose', False) or random.random() < self.rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """Ставит запись в очередь без форматирования; при переполнении очереди запись отбрасывается."""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Стандартный QueueHandler форматирует сообщение в вызывающем потоке; здесь это делает слушатель
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LazyQueueHandler.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-запись на строку; сообщение обрезается и очищается от ключей."""
+
+    def format(self, record):
+        message = redact(record.getMessage())
+        if len(message) > LOG_MAX_MESSAGE_LENGTH:
+            message = message[:LOG_MAX_MESSAGE_LENGTH] + f'... [{len(message)} chars]'
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': message,
+        }
+        if record.exc_text:
+            entry['exception'] = redact(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        message = redact(super().format(record))
+        if len(message) > LOG_MAX_MESSAGE_LENGTH:
+            message = message[:LOG_MAX_MESSAGE_LENGTH] + f'... [{len(message)} chars]'
+        return message
+
 
 def setup_logging():
-    logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S')
+    global _listener
+    if _listener is not None:
+        return
+
+    # Файл и консоль пишет отдельный поток; обработчики сообщений только кладут записи в очередь
+    file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(RedactingFormatter('%(asctime)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S'))
 
-    # Проверяем, добавлен ли StreamHandler корневому логгеру
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_VERBOSE_SAMPLE_RATE))
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(LOG_LEVEL)
+    root_logger.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    # Оставшиеся в очереди записи дописываются при завершении процесса
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    # Процессы multiprocessing завершаются без atexit и должны вызвать stop_logging() сами
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_after_fork():
+    # Поток записи логов не переживает fork: дочерний процесс заводит свою очередь и свой поток
+    global _listener
+    if _listener is None:
+        return
     root_logger = logging.getLogger()
-    if not any(isinstance(handler, logging.StreamHandler) for handler in root_logger.handlers):
-        # Добавляем StreamHandler для вывода в консоль, если он ещё не добавлен
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)  # Настроить при необходимости
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S')
-        console_handler.setFormatter(formatter)
-        root_logger.addHandler(console_handler)
-
-setup_logging()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, LazyQueueHandler):
+            root_logger.removeHandler(handler)
+    _listener = None
+    setup_logging()
+
+os.register_at_fork(after_in_child=_restart_after_fork)
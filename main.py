@@ -1,95 +1,165 @@
 #main.py
+# Время запуска отсчитывается до остальных импортов
+import time
+STARTED = time.perf_counter()
 # Необходимые импорты
 import logging
+import math
 import requests
-import time
 import json
+import signal
+import threading
+from contextlib import ExitStack, contextmanager
+from functools import wraps
 from datetime import datetime
-from telegram import Update, ChatAction
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
-from config import TELEGRAM_BOT_TOKEN, AVAILABLE_MODELS
-from log_config import setup_logging
+from telegram import Bot, Update
+from telegram.error import BadRequest
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, DispatcherHandlerStop
+from config import (TELEGRAM_BOT_TOKEN, TELEGRAM_BASE_URL, AVAILABLE_MODELS, ASYNC_DISPATCH, MAX_CONCURRENT_UPDATES,
+                    TYPING_ACTION_INTERVAL, STREAM_RESPONSES, STREAM_EDIT_INTERVAL, TELEGRAM_MESSAGE_LIMIT,
+                    CONTEXT_SUMMARY_TOKENS, MESSAGE_WRITE_BEHIND, METRICS_ENABLED, METRICS_HOST, METRICS_PORT,
+                    ADMIN_IDS, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+                    RESPONSE_CACHE_PERSIST, RESPONSE_CACHE_MAX_MESSAGES, RESPONSE_CACHE_WAIT_TIMEOUT, UPDATE_MODE,
+                    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_WORKERS,
+                    WEBHOOK_QUEUE_SIZE, TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST, TELEGRAM_CHAT_RATE,
+                    TELEGRAM_CHAT_BURST, TELEGRAM_GROUP_RATE_PER_MIN, TELEGRAM_SEND_RETRIES, USER_RATE_LIMIT_PER_MIN, USER_RATE_LIMIT_BURST, MODEL_RATE_LIMIT_PER_MIN,
+                    MODEL_RATE_LIMIT_BURST, MESSAGE_RETENTION_DAYS, MESSAGE_RETENTION_COUNT, RETENTION_INTERVAL,
+                    RETENTION_BATCH_SIZE, RETENTION_VACUUM_PAGES, RATE_LIMIT_NOTICE_INTERVAL, UPSTREAM_MAX_CONCURRENT, USER_CACHE_SIZE,
+                    STARTUP_TIME_BUDGET, FALLBACK_MIN_CONTEXT_SHARE)
+from log_config import setup_logging, stop_logging
 # Импортируйте SessionLocal для создания сессий и Session для аннотации
-from db import (get_user_by_telegram_id, create_or_update_user, update_user_api_key, update_user_model,
-                add_message, get_user_messages, delete_user_messages, SessionLocal)
-from openrouter import send_to_openrouter
+from db import (get_user_profile, invalidate_user_profile, create_or_update_user, update_user_model,
+                update_user_fallback_model, set_awaiting_model_choice, delete_user_messages, mark_api_key_invalid,
+                init_db, dispose_engine, message_writer, user_profiles, SessionLocal)
+from openrouter import (Fallback, send_to_openrouter, stream_from_openrouter, request_completion, check_api_key, forget_api_key,
+                        api_key_cache, client as openrouter_client)
+from metrics import (timed, track_handler, start_metrics_server, stage_duration, handler_duration,
+                     upstream_tokens_total, response_cache_total, rate_limited_total, upstream_hedges_total,
+                     upstream_hedge_wins_total)
+from context_builder import build_context, fit_context, estimate_tokens, reply_reserve, MODEL_CONTEXT_WINDOWS
+from scheduler import UpdateScheduler
+from retention import RetentionJob
+from sender import TelegramSender, split_message
+from limits import RateLimiter, RateLimitExceeded, FairSemaphore
+from cache import TTLCache
+from response_cache import ResponseCache
+from webhook import WorkerPool, start_webhook_server
 from models import User
 from sqlalchemy.orm import Session  # Только для аннотации типов
 
 
 
 
-# Настройка логгирования
-setup_logging()
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Логирование настраивается в main(): импорт модуля не открывает файлов и не запускает потоков
 logger = logging.getLogger(__name__)
 
+# Планировщик обновлений: параллельная обработка чатов с сохранением порядка внутри чата
+scheduler = UpdateScheduler(MAX_CONCURRENT_UPDATES)
+
+# Все исходящие сообщения и индикатор "печатает..." проходят через отправитель с учётом лимитов Bot API
+sender = TelegramSender(TELEGRAM_MESSAGE_LIMIT, global_rate=TELEGRAM_GLOBAL_RATE, global_burst=TELEGRAM_GLOBAL_BURST,
+                        chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                        group_rate=TELEGRAM_GROUP_RATE_PER_MIN / 60, typing_interval=TYPING_ACTION_INTERVAL,
+                        max_retries=TELEGRAM_SEND_RETRIES)
+
+# Кэш ответов на одинаковые запросы (None, если выключен в настройках)
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+                               session_factory=SessionLocal if RESPONSE_CACHE_PERSIST else None,
+                               max_messages=RESPONSE_CACHE_MAX_MESSAGES,
+                               wait_timeout=RESPONSE_CACHE_WAIT_TIMEOUT) if RESPONSE_CACHE_ENABLED else None
+
+# Очистка истории сверх заданного срока хранения и числа сообщений на пользователя
+retention = RetentionJob(SessionLocal, max_age_days=MESSAGE_RETENTION_DAYS,
+                         max_per_user=MESSAGE_RETENTION_COUNT, interval=RETENTION_INTERVAL,
+                         batch_size=RETENTION_BATCH_SIZE, vacuum_pages=RETENTION_VACUUM_PAGES)
+
+# Лимиты частоты сообщений пользователя и запросов к модели, справедливая очередь к OpenRouter
+user_limiter = RateLimiter(USER_RATE_LIMIT_PER_MIN / 60, USER_RATE_LIMIT_BURST)
+model_limiter = RateLimiter(MODEL_RATE_LIMIT_PER_MIN / 60, MODEL_RATE_LIMIT_BURST)
+upstream_slots = FairSemaphore(UPSTREAM_MAX_CONCURRENT)
+# Пользователи, уже получившие уведомление о превышении лимита
+rate_limit_notices = TTLCache(USER_CACHE_SIZE, RATE_LIMIT_NOTICE_INTERVAL)
+
 def send_typing_action(chat_id, context):
-    context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-    time.sleep(1)
+    sender.chat_action(context.bot, chat_id)
 
+@track_handler
 def start(update: Update, context: CallbackContext) -> None:
     welcome_message = """
     🤖 Привет! Я - бот, помогающий взаимодействовать с ИИ через OpenRouter.
     Для начала, пожалуйста, введите ваш API ключ от OpenRouter командой /api <API_KEY>.
     Это позволит мне обрабатывать ваши запросы с использованием выбранной модели ИИ.
     """
-    update.message.reply_text(welcome_message)
+    sender.reply(update.message, welcome_message)
 
 def validate_api_key(api_key: str, user_id: int, session: Session) -> bool:
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    # Определите структуру данных в соответствии с требованиями вашего API
-    data = {
-        "model": "openai/gpt-3.5-turbo",  # Используйте модель по умолчанию для проверки
-        "messages": [{"role": "user", "content": "Hello"}]  # Простой запрос для проверки ключа
-    }
-
     try:
-        # Отправляем запрос на API для проверки ключа
-        response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data)
-        
-        # Проверяем успешный статус код, обычно 200 для успешной проверки
-        is_valid = response.status_code == 200
+        # Ключ проверяется через эндпоинт сведений о ключе, повторная проверка берётся из кэша
+        is_valid = check_api_key(api_key)
 
         # Обновляем статус валидности API ключа в базе данных для пользователя
         user = session.query(User).filter(User.telegram_id == user_id).first()
         if user:
             user.is_valid = is_valid
             session.commit()
+            invalidate_user_profile(user_id)
 
         if is_valid:
-            logger.info(f"API key for user {user_id} is valid.")
+            logger.info("API key for user %s is valid.", user_id)
         else:
-            logger.info(f"API key validation failed for user {user_id} with status code {response.status_code}: {response.text}")
+            logger.info("API key validation failed for user %s.", user_id)
 
         return is_valid
     except Exception as e:
-        logger.error(f"Error validating API key for user {user_id}: {e}")
+        logger.error("Error validating API key for user %s: %s", user_id, e)
         return False
 
 
+# Ключи, повторная проверка которых уже выполняется в фоне
+_revalidating_keys = set()
+_revalidating_lock = threading.Lock()
+
+def revalidate_api_key(api_key: str):
+    # Запрос к модели отклонён с 401/403: ключ перепроверяется в фоне, не задерживая ответ пользователю
+    with _revalidating_lock:
+        if api_key in _revalidating_keys:
+            return
+        _revalidating_keys.add(api_key)
+    threading.Thread(target=_revalidate_api_key, args=(api_key,), name='api-key-revalidation', daemon=True).start()
+
+def _revalidate_api_key(api_key: str):
+    try:
+        forget_api_key(api_key)
+        if not check_api_key(api_key):
+            with SessionLocal() as session:
+                telegram_ids = mark_api_key_invalid(api_key, session)
+            logger.info("API key revoked for users %s.", telegram_ids)
+    except Exception as e:
+        logger.error("Error revalidating API key: %s", e)
+    finally:
+        with _revalidating_lock:
+            _revalidating_keys.discard(api_key)
+
+
 
+@track_handler
 def api(update: Update, context: CallbackContext) -> None:
-    send_typing_action(update.message.chat_id, context)
     api_key = ' '.join(context.args)
     if not api_key:
-        update.message.reply_text('Пожалуйста, отправьте API ключ после команды /api.')
+        sender.reply(update.message, 'Пожалуйста, отправьте API ключ после команды /api.')
         return
 
     user_id = update.effective_user.id
     # Используем SessionLocal для создания новой сессии
     with SessionLocal() as session:
-        if validate_api_key(api_key, user_id, session):
+        with sender.typing(context.bot, update.message.chat_id):
+            is_valid = validate_api_key(api_key, user_id, session)
+        if is_valid:
             # Обновляем или создаем пользователя с новым ключом внутри сессии
             user = create_or_update_user(user_id, api_key, session)
-            # Дополнительная логика с пользователем, если нужно
-            context.user_data['api_key_valid'] = True
-            update.message.reply_text('API ключ действителен. Теперь вы можете выбрать модель командой /model.')
+            sender.reply(update.message, 'API ключ действителен. Теперь вы можете выбрать модель командой /model.')
         else:
-            update.message.reply_text('API ключ недействителен. Пожалуйста, введите другой ключ командой /api.')
+            sender.reply(update.message, 'API ключ недействителен. Пожалуйста, введите другой ключ командой /api.')
         # Сессия автоматически закроется после выхода из блока with
 
 
@@ -97,20 +167,21 @@ def api(update: Update, context: CallbackContext) -> None:
 
 
 def restricted_access(func):
+    @wraps(func)
     def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
         user_id = update.effective_user.id
-        with SessionLocal() as session:  # Используйте context manager для создания сессии
-            db_user = get_user_by_telegram_id(user_id, session)  # Передайте сессию как аргумент
-            if db_user and db_user.api_key and db_user.is_valid:
-                return func(update, context, *args, **kwargs)
-            else:
-                update.message.reply_text('Пожалуйста, введите действующий API ключ командой /api.')
-                return
+        db_user = get_user_profile(user_id)  # Профиль из кэша, без обращения к базе при попадании
+        if db_user and db_user.api_key and db_user.is_valid:
+            return func(update, context, *args, **kwargs)
+        else:
+            sender.reply(update.message, 'Пожалуйста, введите действующий API ключ командой /api.')
+            return
     return wrapper
 
 
 
 
+@track_handler
 @restricted_access
 def help_command(update: Update, context: CallbackContext) -> None:
     send_typing_action(update.message.chat_id, context)
@@ -121,106 +192,425 @@ def help_command(update: Update, context: CallbackContext) -> None:
     /start - начать диалог.
     /api <API_KEY> - установить ваш API ключ.
     /model - выбрать модель ИИ для диалога.
+    /fallback - выбрать резервную модель на случай медленного ответа или сбоя основной.
     /new - начать новую сессию, очистив историю сообщений.
     /help - показать эту справку.
     """
-    update.message.reply_text(help_text)
+    sender.reply(update.message, help_text)
 
+@track_handler
 @restricted_access
 def model(update: Update, context: CallbackContext) -> None:
     send_typing_action(update.message.chat_id, context)
     user_id = update.effective_user.id
     
-    with SessionLocal() as session:  # Создаем новую сессию
-        db_user = get_user_by_telegram_id(user_id, session)  # Передаем сессию как аргумент
-        if db_user and db_user.model_id:
-            current_model_info = f"Текущая модель: {db_user.model_id}, токены: {db_user.max_tokens if db_user.max_tokens else 'не указано'}."
-            update.message.reply_text(current_model_info)
-            
-        message = "Выберите модель, отправив её номер:\n\n"
+    db_user = get_user_profile(user_id)
+    if db_user and db_user.model_id:
+        current_model_info = f"Текущая модель: {db_user.model_id}, токены: {db_user.max_tokens if db_user.max_tokens else 'не указано'}."
+        sender.reply(update.message, current_model_info)
+        
+    message = "Выберите модель, отправив её номер:\n\n"
+    for key, value in AVAILABLE_MODELS.items():
+        message += f"{key}: {value['name']}\n"
+    sender.reply(update.message, message)
+    with SessionLocal() as session:
+        set_awaiting_model_choice(user_id, True, session)
+
+
+@track_handler
+@restricted_access
+def fallback(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    db_user = get_user_profile(user_id)
+    choice = ' '.join(context.args).strip().lower()
+    if not choice:
+        message = (f"Резервная модель: {db_user.fallback_model_id or 'не выбрана'}.\n\n"
+                   "Если основная модель отвечает дольше обычного или недоступна, запрос уходит и резервной, "
+                   "а в чат попадает ответ той модели, что начала отвечать первой.\n"
+                   "Выберите резервную модель командой /fallback <номер> или отключите её командой /fallback off:\n\n")
         for key, value in AVAILABLE_MODELS.items():
             message += f"{key}: {value['name']}\n"
-        update.message.reply_text(message)
-        context.user_data['awaiting_model_choice'] = True
-
+        sender.reply(update.message, message)
+        return
 
+    with SessionLocal() as session:
+        if choice == 'off':
+            update_user_fallback_model(user_id, None, session)
+            sender.reply(update.message, "Резервная модель отключена.")
+            return
+        try:
+            chosen_model = AVAILABLE_MODELS[int(choice)]
+        except (ValueError, KeyError):
+            sender.reply(update.message, "Выбран недопустимый номер модели. Список моделей - по команде /fallback.")
+            return
+        if chosen_model['name'] == db_user.model_id:
+            sender.reply(update.message, "Резервная модель должна отличаться от основной.")
+            return
+        primary_window = MODEL_CONTEXT_WINDOWS.get(db_user.model_id)
+        if primary_window and chosen_model['max_tokens'] < primary_window * FALLBACK_MIN_CONTEXT_SHARE:
+            sender.reply(update.message, f"Контекст {chosen_model['name']} ({chosen_model['max_tokens']} токенов) намного "
+                                         f"меньше, чем у основной модели ({primary_window}): большая часть истории "
+                                         "в резервный запрос не попадёт. Выберите модель с окном побольше.")
+            return
+        update_user_fallback_model(user_id, chosen_model['name'], session)
+    sender.reply(update.message, f"Резервная модель: {chosen_model['name']}.")
+
+
+@track_handler
 @restricted_access
 def new_session(update: Update, context: CallbackContext) -> None:
     send_typing_action(update.message.chat_id, context)
     user_id = update.effective_user.id
-    context.user_data.clear()
 
+    db_user = get_user_profile(user_id)
     with SessionLocal() as session:  # Создание новой сессии
-        delete_user_messages(user_id, session)  # Передача сессии как аргумента
+        if db_user:
+            if db_user.awaiting_model_choice:
+                set_awaiting_model_choice(user_id, False, session)
+            # В messages.user_id хранится users.id, а не Telegram ID
+            delete_user_messages(db_user.id, session)
 
-    update.message.reply_text('Новая сессия начата. Ваши предыдущие данные очищены.')
+    sender.reply(update.message, 'Новая сессия начата. Ваши предыдущие данные очищены.')
 
 
+def edit_reply(reply, text: str, shown: str, wait: bool = True) -> str:
+    """Редактирует сообщение, если видимый текст изменился; возвращает показанный текст.
+
+    Без wait редактирование пропускается, если лимит чата сейчас исчерпан: следующее его догонит.
+    """
+    visible = text[:TELEGRAM_MESSAGE_LIMIT]
+    if visible == shown:
+        return shown
+    try:
+        with timed('telegram_edit'):
+            if not sender.edit(reply, visible, wait=wait):
+                return shown
+        return visible
+    except BadRequest as e:
+        # "Message is not modified" и подобные ошибки не должны прерывать поток
+        logger.warning("Failed to edit streamed reply: %s", e)
+        return shown
+
+
+def stream_reply(update: Update, context: CallbackContext, chunks, on_complete=None) -> str:
+    """Показывает ответ по мере генерации, редактируя одно сообщение не чаще STREAM_EDIT_INTERVAL.
+
+    on_complete(text) вызывается, как только поток дочитан, до финального редактирования и
+    отправки остальных частей: ошибка Telegram на этих шагах не теряет уже оплаченный ответ.
+    """
+    text = ''
+    shown = ''
+    reply = None
+    next_edit = 0.0
+    with ExitStack() as typing:
+        # Индикатор "печатает..." нужен только до появления первого фрагмента ответа
+        typing.enter_context(sender.typing(context.bot, update.message.chat_id))
+        for chunk in chunks:
+            text += chunk
+            if not text.strip() or time.monotonic() < next_edit:
+                continue
+            if reply is None:
+                typing.close()
+                shown = text[:TELEGRAM_MESSAGE_LIMIT]
+                with timed('telegram_send'):
+                    reply = sender.reply(update.message, shown)[0]
+            else:
+                shown = edit_reply(reply, text, shown, wait=False)
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    if on_complete is not None:
+        on_complete(text)
+    if reply is None:
+        sender.reply(update.message, text)
+        return text
+    # Длинный ответ делится по границам строк и блоков кода: первая часть остаётся в том же сообщении
+    parts = split_message(text, TELEGRAM_MESSAGE_LIMIT)
+    edit_reply(reply, parts[0], shown)
+    for part in parts[1:]:
+        sender.reply(update.message, part)
+    return text
+
+
+def check_rate_limit(update: Update, context: CallbackContext) -> None:
+    # Выполняется до постановки обновления в очередь чата: сообщение сверх лимита не доходит до базы и модели
+    if update.effective_user is None:
+        return
+    user_id = update.effective_user.id
+    retry_after = user_limiter.acquire(user_id)
+    if not retry_after:
+        return
+    rate_limited_total.inc(scope='user')
+    if rate_limit_notices.get(user_id) is None:
+        rate_limit_notices.set(user_id, True)
+        notice = f'Слишком много сообщений. Попробуйте снова через {math.ceil(retry_after)} с.'
+        if scheduler.running:
+            # Отдельная очередь: уведомление не ждёт, пока обработаются уже принятые сообщения чата
+            scheduler.submit(('rate_limit', update.message.chat_id), sender.reply, update.message, notice)
+        else:
+            sender.reply(update.message, notice)
+    raise DispatcherHandlerStop
+
+
+@contextmanager
+def upstream_slot(user_id: int, model_id: str = None):
+    # Жетон модели списывается только за настоящее обращение к OpenRouter, не за ответ из кэша
+    if model_id is not None:
+        retry_after = model_limiter.acquire(model_id)
+        if retry_after:
+            rate_limited_total.inc(scope='model')
+            raise RateLimitExceeded(retry_after)
+    # При занятых местах запросы ждут своей очереди, пользователи обслуживаются по кругу
+    with timed('upstream_wait'):
+        upstream_slots.acquire(user_id)
+    try:
+        yield
+    finally:
+        upstream_slots.release()
+
+
+def reply_model_busy(update: Update, model_id: str, retry_after: float):
+    sender.reply(update.message, f"Модель {model_id} перегружена запросами. "
+                                 f"Попробуйте снова через {math.ceil(retry_after)} с.")
+
+
+def summarize_history(db_user: User, text: str):
+    try:
+        with upstream_slot(db_user.telegram_id):
+            return request_completion(text, db_user.api_key, db_user.model_id, max_tokens=CONTEXT_SUMMARY_TOKENS)
+    except requests.exceptions.RequestException as e:
+        logger.error("Error summarizing history for user %s: %s", db_user.telegram_id, e)
+        return None
+
+
+@track_handler
 @restricted_access
 def handle_message(update: Update, context: CallbackContext) -> None:
-    send_typing_action(update.message.chat_id, context)
     user_id = update.effective_user.id
     
+    db_user = get_user_profile(user_id)
     with SessionLocal() as session:  # Создаем новую сессию
-        db_user = get_user_by_telegram_id(user_id, session)  # Передаем сессию как аргумент
-        
-        if 'awaiting_model_choice' in context.user_data and context.user_data['awaiting_model_choice']:
+        if db_user.awaiting_model_choice:
             try:
                 choice = int(update.message.text)
                 if choice in AVAILABLE_MODELS:
                     chosen_model = AVAILABLE_MODELS[choice]
                     # Убедитесь, что функция update_user_model принимает сессию как аргумент
                     update_user_model(user_id, chosen_model['name'], chosen_model.get('max_tokens', 1024), session)
-                    update.message.reply_text(f"Модель успешно изменена на {chosen_model['name']} с максимальным количеством токенов {chosen_model.get('max_tokens', 1024)}.")
-                    context.user_data['awaiting_model_choice'] = False
+                    set_awaiting_model_choice(user_id, False, session)
+                    sender.reply(update.message, f"Модель успешно изменена на {chosen_model['name']} с максимальным количеством токенов {chosen_model.get('max_tokens', 1024)}.")
                 else:
-                    update.message.reply_text("Выбран недопустимый номер модели. Пожалуйста, выберите модель из списка командой /model.")
+                    sender.reply(update.message, "Выбран недопустимый номер модели. Пожалуйста, выберите модель из списка командой /model.")
             except ValueError:
-                update.message.reply_text("Пожалуйста, введите номер модели из списка, предоставленного командой /model.")
+                sender.reply(update.message, "Пожалуйста, введите номер модели из списка, предоставленного командой /model.")
         else:
-            if db_user and db_user.api_key and db_user.model_id:
-                stored_messages = sorted(
-                    get_user_messages(user_id, session),  # Передаем сессию как аргумент
-                    key=lambda message: message.id
-                )
-                role_mapping = {'in': 'user', 'out': 'assistant'}
-                message_history = [
-                    {
-                        "role": role_mapping.get(stored_message.direction, 'assistant'),
-                        "content": stored_message.text
-                    }
-                    for stored_message in stored_messages
-                ]
-
-                response_message = send_to_openrouter(
-                    update.message.text,
-                    db_user.api_key,
-                    db_user.model_id,
-                    max_tokens=db_user.max_tokens,
-                    message_history=message_history
-                )
-                add_message(user_id, update.message.text, datetime.now(), 'in', session)  # Передаем сессию как аргумент
-                add_message(user_id, response_message, datetime.now(), 'out', session)  # Передаем сессию как аргумент
-                update.message.reply_text(response_message)
+            if db_user and db_user.api_key and db_user.model_id:
+                # В запрос попадает только та часть истории, которая помещается в бюджет токенов модели
+                with timed('db_context', model=db_user.model_id):
+                    message_history = build_context(db_user, update.message.text, session,
+                                                    summarize=lambda text: summarize_history(db_user, text))
+
+                # Ответ ограничен тем же резервом, что был вычтен из бюджета истории: запрос помещается в окно
+                max_tokens = reply_reserve(db_user.model_id, db_user.max_tokens)
+
+                # Страховочные запросы включаются выбором резервной модели (/fallback); её история и
+                # max_tokens подбираются под её собственное окно, которое может быть меньше окна основной
+                fallback_request = None
+                if db_user.fallback_model_id and db_user.fallback_model_id != db_user.model_id:
+                    fallback_request = Fallback(db_user.fallback_model_id, reply_reserve(db_user.fallback_model_id),
+                                                fit_context(message_history, update.message.text, db_user.fallback_model_id))
+                # Место в очереди к OpenRouter и жетон модели занимаются только на время настоящего запроса
+                slot = lambda: upstream_slot(user_id, db_user.model_id)
+
+                def save_turn(response_message):
+                    # Сообщения попадают в очередь пакетной записи, коммит выполняет фоновый поток
+                    message_writer.add(db_user.id, update.message.text, datetime.now(), 'in',
+                                       token_count=estimate_tokens(update.message.text))
+                    message_writer.add(db_user.id, response_message, datetime.now(), 'out',
+                                       token_count=estimate_tokens(response_message))
+
+                if STREAM_RESPONSES:
+                    try:
+                        stream_reply(update, context, stream_from_openrouter(
+                            update.message.text,
+                            db_user.api_key,
+                            db_user.model_id,
+                            max_tokens=max_tokens,
+                            message_history=message_history,
+                            cache=response_cache,
+                            fallback=fallback_request,
+                            slot=slot
+                        ), on_complete=save_turn)
+                    except RateLimitExceeded as e:
+                        reply_model_busy(update, db_user.model_id, e.retry_after)
+                        return
+                else:
+                    try:
+                        with sender.typing(context.bot, update.message.chat_id):
+                            response_message = send_to_openrouter(
+                                update.message.text,
+                                db_user.api_key,
+                                db_user.model_id,
+                                max_tokens=max_tokens,
+                                message_history=message_history,
+                                cache=response_cache,
+                                fallback=fallback_request,
+                                slot=slot
+                            )
+                    except RateLimitExceeded as e:
+                        reply_model_busy(update, db_user.model_id, e.retry_after)
+                        return
+                    save_turn(response_message)
+                    with timed('telegram_send', model=db_user.model_id):
+                        sender.reply(update.message, response_message)
             else:
-                update.message.reply_text("Модель не выбрана. Пожалуйста, выберите модель командой /model.")
+                sender.reply(update.message, "Модель не выбрана. Пожалуйста, выберите модель командой /model.")
 
 
 
 
-def main():
-    updater = Updater(TELEGRAM_BOT_TOKEN)
-    dispatcher = updater.dispatcher
+@track_handler
+def stats(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        sender.reply(update.message, 'Команда доступна только администраторам.')
+        return
 
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("api", api, pass_args=True))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("model", model))
-    dispatcher.add_handler(CommandHandler("new", new_session))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+    lines = ['📊 Этапы обработки (количество, p50, p95):']
+    for stage, (count, p50, p95) in sorted(stage_duration.summary('stage').items()):
+        lines.append(f'{stage}: {count}, {p50:g} с, {p95:g} с')
+    lines.append('\nОбработчики (количество, p50, p95):')
+    for handler, (count, p50, p95) in sorted(handler_duration.summary('handler').items()):
+        lines.append(f'{handler}: {count}, {p50:g} с, {p95:g} с')
+    lines.append(f"\nТокены: запрос {upstream_tokens_total.total(kind='prompt_tokens'):g}, "
+                 f"ответ {upstream_tokens_total.total(kind='completion_tokens'):g}")
+    for name, cache in (('Профили', user_profiles), ('API ключи', api_key_cache)):
+        cache_stats = cache.stats()
+        lines.append(f"{name}: {cache_stats['size']} записей, попаданий {cache_stats['hit_ratio']:.0%}")
+    lines.append(f"\nЗапросы к OpenRouter: выполняется {upstream_slots.active}, ждут {upstream_slots.waiting}; "
+                 f"отклонено по лимиту пользователя {rate_limited_total.total(scope='user'):g}, "
+                 f"модели {rate_limited_total.total(scope='model'):g}")
+    lines.append(f"Страховочные запросы: по задержке {upstream_hedges_total.total(reason='slow'):g}, "
+                 f"по ошибке {upstream_hedges_total.total(reason='error'):g}; "
+                 f"первой ответила резервная модель {upstream_hedge_wins_total.total(winner='fallback'):g}")
+    if response_cache is not None:
+        lines.append(f"Ответы: {len(response_cache.memory)} записей, попаданий {response_cache_total.total(result='hit'):g}, "
+                     f"объединено {response_cache_total.total(result='coalesced'):g}, "
+                     f"промахов {response_cache_total.total(result='miss'):g}")
+    sender.reply(update.message, '\n'.join(lines))
+
+
+def create_updater() -> Updater:
+    # Пул соединений с Bot API рассчитан на все одновременно обрабатываемые обновления
+    return Updater(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_BASE_URL,
+                   request_kwargs={'con_pool_size': MAX_CONCURRENT_UPDATES + 4})
+
+
+def register_handlers(dispatcher):
+    # В асинхронном режиме обработчики только ставят обновление в очередь чата
+    dispatch = scheduler.wrap if ASYNC_DISPATCH else (lambda handler: handler)
+
+    if user_limiter.enabled:
+        # Группа -1 проверяется раньше остальных обработчиков и синхронно, без очереди чата
+        dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, check_rate_limit), group=-1)
+    dispatcher.add_handler(CommandHandler("start", dispatch(start)))
+    dispatcher.add_handler(CommandHandler("api", dispatch(api), pass_args=True))
+    dispatcher.add_handler(CommandHandler("help", dispatch(help_command)))
+    dispatcher.add_handler(CommandHandler("model", dispatch(model)))
+    dispatcher.add_handler(CommandHandler("fallback", dispatch(fallback), pass_args=True))
+    dispatcher.add_handler(CommandHandler("new", dispatch(new_session)))
+    dispatcher.add_handler(CommandHandler("stats", dispatch(stats)))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, dispatch(handle_message)))
+
+
+def start_services(metrics_port: int, background_jobs: bool = True):
+    openrouter_client.on_auth_error = revalidate_api_key
+    if response_cache is not None:
+        response_cache.purge()
+    if METRICS_ENABLED:
+        start_metrics_server(METRICS_HOST, metrics_port)
+    scheduler.start()
+    sender.start()
+    if MESSAGE_WRITE_BEHIND:
+        message_writer.start()
+    if background_jobs:
+        retention.start()
+
+
+def stop_services():
+    retention.stop()
+    scheduler.stop()
+    sender.stop()
+    # Сообщения, оставшиеся в очереди, записываются перед выходом
+    message_writer.stop()
+
+
+def run_polling():
+    updater = create_updater()
+    start_services(METRICS_PORT)
+    register_handlers(updater.dispatcher)
 
     updater.start_polling()
     updater.idle()
+    stop_services()
+
+
+def run_worker(index: int, updates):
+    """Процесс-обработчик webhook-режима: обрабатывает обновления своей доли чатов из очереди updates."""
+    # Ctrl+C получает вся группа процессов; остановкой обработчиков управляет родитель
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Обновления передаются в process_update() напрямую, потоки диспетчера и getUpdates не запускаются
+    updater = create_updater()
+    # У каждого процесса свои метрики и свой эндпоинт: METRICS_PORT + 1 + номер процесса
+    # Очистку истории выполняет только первый процесс
+    start_services(METRICS_PORT + 1 + index, background_jobs=index == 0)
+    register_handlers(updater.dispatcher)
+    try:
+        while True:
+            body = updates.get()
+            if body is None:
+                break
+            try:
+                updater.dispatcher.process_update(Update.de_json(json.loads(body), updater.bot))
+            except Exception:
+                logger.exception("Failed to process a webhook update")
+    finally:
+        stop_services()
+        stop_logging()
+
+
+def run_webhook():
+    # Соединения с базой не должны наследоваться процессами-обработчиками
+    dispose_engine()
+    pool = WorkerPool(run_worker, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    pool.start()
+    server = start_webhook_server(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, pool, WEBHOOK_SECRET)
+    if WEBHOOK_URL:
+        api_kwargs = {'secret_token': WEBHOOK_SECRET} if WEBHOOK_SECRET else None
+        Bot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_BASE_URL).set_webhook(WEBHOOK_URL, api_kwargs=api_kwargs)
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopping.set())
+    logger.info("Webhook mode started with %d update workers", WEBHOOK_WORKERS)
+    while not stopping.wait(1):
+        pool.check()
+
+    server.shutdown()
+    pool.stop()
+
+
+def main():
+    setup_logging()
+    init_db()
+    startup = time.perf_counter() - STARTED
+    stage_duration.observe(startup, stage='startup', outcome='ok')
+    if startup > STARTUP_TIME_BUDGET:
+        logger.warning("Startup took %.2f s, over the %.2f s budget", startup, STARTUP_TIME_BUDGET)
+    else:
+        logger.info("Startup took %.2f s", startup)
+    if UPDATE_MODE == 'webhook':
+        run_webhook()
+    else:
+        run_polling()
 
 if __name__ == '__main__':
     main()
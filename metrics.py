@@ -0,0 +1,203 @@
+#metrics.py
+# Лёгкие метрики задержек и пропускной способности с экспортом в текстовом формате Prometheus
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах: от быстрых запросов к SQLite до долгих генераций
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self, **labels) -> float:
+        # Сумма по всем сериям, у которых совпадают указанные метки
+        wanted = set(_label_key(labels))
+        with self._lock:
+            return sum(value for key, value in self._values.items() if wanted <= set(key))
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._series = {}  # метки -> [счётчики корзин (последняя - +Inf), сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def summary(self, group_by: str) -> dict:
+        """Сводка по значениям одной метки: {значение: (количество, p50, p95)}; квантили - по корзинам."""
+        merged = {}
+        with self._lock:
+            for key, (counts, _, count) in self._series.items():
+                group = dict(key).get(group_by, '')
+                total = merged.setdefault(group, [[0] * len(counts), 0])
+                total[0] = [a + b for a, b in zip(total[0], counts)]
+                total[1] += count
+        return {group: (count, self._quantile(counts, count, 0.5), self._quantile(counts, count, 0.95))
+                for group, (counts, count) in merged.items()}
+
+    def totals(self, group_by: str) -> dict:
+        """Количество наблюдений и суммарное время по значениям одной метки: {значение: (количество, сумма)}."""
+        merged = {}
+        with self._lock:
+            for key, (_, total, count) in self._series.items():
+                group = dict(key).get(group_by, '')
+                previous = merged.get(group, (0, 0.0))
+                merged[group] = (previous[0] + count, previous[1] + total)
+        return merged
+
+    def _quantile(self, counts, count, q):
+        if not count:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_format_labels(key, (("le", bound),))} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+stage_duration = Histogram('openbot_stage_duration_seconds',
+                           'Duration of individual processing stages (db, upstream, telegram)')
+handler_duration = Histogram('openbot_handler_duration_seconds', 'Total duration of Telegram update handlers')
+updates_total = Counter('openbot_updates_total', 'Handled Telegram updates')
+upstream_requests_total = Counter('openbot_upstream_requests_total', 'OpenRouter HTTP requests by status')
+upstream_tokens_total = Counter('openbot_upstream_tokens_total', 'Tokens reported by OpenRouter usage')
+response_cache_total = Counter('openbot_response_cache_total', 'Response cache lookups by result')
+rate_limited_total = Counter('openbot_rate_limited_total', 'Messages rejected by rate limits')
+telegram_flood_waits_total = Counter('openbot_telegram_flood_waits_total', 'Telegram 429 responses with retry_after')
+upstream_hedges_total = Counter('openbot_upstream_hedges_total', 'Requests sent to a fallback model by reason')
+upstream_hedge_wins_total = Counter('openbot_upstream_hedge_wins_total', 'Hedged requests by the model that answered first')
+
+REGISTRY = [stage_duration, handler_duration, updates_total, upstream_requests_total, upstream_tokens_total,
+            response_cache_total, rate_limited_total, telegram_flood_waits_total, upstream_hedges_total,
+            upstream_hedge_wins_total]
+
+
+@contextmanager
+def timed(stage: str, **labels):
+    """Замеряет длительность блока; исключение внутри блока даёт outcome="error"."""
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        stage_duration.observe(time.perf_counter() - start, stage=stage, outcome=outcome, **labels)
+
+
+def track_handler(func):
+    """Считает вызовы обработчика и его полную длительность."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - start, handler=func.__name__, outcome=outcome)
+            updates_total.inc(handler=func.__name__, outcome=outcome)
+    return wrapper
+
+
+def record_usage(model_id: str, usage: dict):
+    # Поле usage ответа OpenRouter: prompt_tokens / completion_tokens
+    if not usage:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if usage.get(kind):
+            upstream_tokens_total.inc(usage[kind], model=model_id, kind=kind)
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info("Metrics endpoint listening on http://%s:%s/metrics", *server.server_address[:2])
+    return server
@@ -1,11 +1,71 @@
 #models.py
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Text, ForeignKey
+import zlib
+from datetime import datetime
+from sqlalchemy import Column, Integer, SmallInteger, String, Boolean, Text, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker, Session
-from config import DATABASE_URL
+from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
+from config import MESSAGE_COMPRESS_THRESHOLD
 
 Base = declarative_base()
 
+# Направление сообщения хранится одним небольшим числом вместо строки
+DIRECTIONS = {'in': 1, 'out': 2}
+DIRECTION_NAMES = {code: name for name, code in DIRECTIONS.items()}
+
+
+class Direction(TypeDecorator):
+    """'in'/'out' в коде, 1/2 в базе."""
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return DIRECTIONS.get(value, value)
+
+    def process_result_value(self, value, dialect):
+        return DIRECTION_NAMES.get(value, value)
+
+
+class EpochTimestamp(TypeDecorator):
+    """datetime в коде, целое число секунд Unix time в базе; строки старого формата тоже принимаются."""
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if isinstance(value, datetime):
+            return int(value.timestamp())
+        return value
+
+    def process_result_value(self, value, dialect):
+        return datetime.fromtimestamp(value) if value is not None else None
+
+
+class CompressedText(TypeDecorator):
+    """Текст длиннее MESSAGE_COMPRESS_THRESHOLD байт сохраняется сжатым zlib в виде BLOB.
+
+    Короткий текст остаётся строкой TEXT; при чтении BLOB распаковывается, поэтому остальной
+    код всегда получает str.
+    """
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        data = value.encode('utf-8')
+        if len(data) <= MESSAGE_COMPRESS_THRESHOLD:
+            return value
+        compressed = zlib.compress(data)
+        return compressed if len(compressed) < len(data) else value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode('utf-8')
+        return value
+
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
@@ -14,6 +74,10 @@ class User(Base):
     model_id = Column(String(250), nullable=True)  # Поле для хранения выбранной модели
     max_tokens = Column(Integer, nullable=True)  # Поле для хранения max_tokens
     is_valid = Column(Boolean, default=True)  # Добавленное поле для индикации валидности API ключа
+    context_summary = Column(Text, nullable=True)  # Краткое содержание отброшенной части диалога
+    summary_upto = Column(Integer, nullable=True)  # id последнего сообщения, учтённого в context_summary
+    awaiting_model_choice = Column(Boolean, default=False)  # Следующее сообщение - номер модели из списка /model
+    fallback_model_id = Column(String(250), nullable=True)  # Резервная модель для страховочных запросов (/fallback)
 
     messages = relationship("Message", back_populates="user", cascade="all, delete-orphan")
 
@@ -21,16 +85,19 @@ class Message(Base):
     __tablename__ = 'messages'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    text = Column(Text, nullable=False)
-    timestamp = Column(String(100), nullable=False)
-    direction = Column(String(10), nullable=False)  # 'in' для входящих, 'out' для исходящих
+    text = Column(CompressedText, nullable=False)
+    timestamp = Column(EpochTimestamp, nullable=False)
+    direction = Column(Direction, nullable=False)  # 'in' для входящих, 'out' для исходящих
+    token_count = Column(Integer, nullable=True)  # Оценка числа токенов, кэшируется при записи
 
     user = relationship("User", back_populates="messages")
 
-# Создание базы данных
-engine = create_engine(DATABASE_URL, echo=True)
-Base.metadata.create_all(engine)
+    # История пользователя читается по (user_id, id) в обратном порядке, без сортировки в памяти
+    __table_args__ = (Index('ix_messages_user_id_id', 'user_id', 'id'),)
 
-# Настройка сессии
-Session = sessionmaker(bind=engine)
-session = Session()
+class CachedResponse(Base):
+    # Сохранённые ответы кэша response_cache: ключ - sha256 от модели, max_tokens и сообщений запроса
+    __tablename__ = 'response_cache'
+    key = Column(String(64), primary_key=True)
+    response = Column(Text, nullable=False)
+    created_at = Column(Integer, nullable=False, index=True)  # Unix time
@@ -1,33 +1,375 @@
 #openrouter.py
+import email.utils
+import hashlib
+import json
+import random
+import threading
+import time
 import requests
 import logging
+from typing import NamedTuple
+from requests.adapters import HTTPAdapter
+from cache import TTLCache
+from hedging import LatencyTracker, hedged_stream
+from log_config import CompactBody
+from metrics import timed, record_usage, stage_duration, upstream_requests_total
+from config import (API_VALIDATE_URL, API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL, OPENROUTER_CONNECT_TIMEOUT, OPENROUTER_READ_TIMEOUT, OPENROUTER_MAX_RETRIES,
+                    OPENROUTER_BACKOFF_BASE, OPENROUTER_BACKOFF_MAX, OPENROUTER_RETRY_AFTER_MAX,
+                    OPENROUTER_POOL_SIZE, CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET, HEDGE_PERCENTILE,
+                    HEDGE_WINDOW, HEDGE_MIN_SAMPLES, HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY)
 
 API_URL = "https://openrouter.ai/api/v1/chat/completions"
 
-def send_to_openrouter(message, api_key, model_id, max_tokens=4096, message_history=None):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    messages_payload = list(message_history) if message_history else []
-    messages_payload.append({"role": "user", "content": message})
-
-    payload = {
-        "model": model_id,
-        "messages": messages_payload,
+# Ответы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Ответы, означающие, что ключ пользователя отозван или недействителен
+AUTH_ERROR_STATUSES = {401, 403}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Запрос не отправлен: после серии ошибок автомат модели временно разомкнут."""
+
+
+class StreamError(requests.exceptions.RequestException):
+    """OpenRouter передал ошибку внутри уже начатого SSE-потока."""
+
+
+class Fallback(NamedTuple):
+    """Резервная модель страховочных запросов с историей и max_tokens, подобранными под её окно."""
+    model_id: str
+    max_tokens: int
+    message_history: list
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold ошибок подряд; через reset_timeout пропускает пробный запрос."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Полуоткрытое состояние: один пробный запрос, остальные ждут следующего окна
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def _retry_after(response) -> float:
+    # Retry-After бывает числом секунд или HTTP-датой
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+class OpenRouterClient:
+    """HTTP-клиент OpenRouter: пул keep-alive соединений, таймауты, повторы и автоматы по моделям."""
+
+    def __init__(self, connect_timeout: float, read_timeout: float, max_retries: int, backoff_base: float,
+                 backoff_max: float, retry_after_max: float, pool_size: int, breaker_threshold: int,
+                 breaker_reset: float):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._breakers = {}
+        self._lock = threading.Lock()
+        # Вызывается с API ключом, если запрос отклонён с 401/403
+        self.on_auth_error = None
+
+    def breaker(self, model_id: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(model_id)
+            if breaker is None:
+                breaker = self._breakers[model_id] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return breaker
+
+    def backoff(self, attempt: int) -> float:
+        # Экспоненциальная задержка с полным джиттером
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def post(self, url: str, api_key: str, payload: dict, stream: bool = False, retries: int = None):
+        """Отправляет POST с повторами; возвращает последний ответ, проверка статуса - на вызывающем."""
+        return self.request("POST", url, api_key, payload, stream=stream, retries=retries)
+
+    def get(self, url: str, api_key: str):
+        return self.request("GET", url, api_key)
+
+    def request(self, method: str, url: str, api_key: str, payload: dict = None, stream: bool = False,
+                retries: int = None):
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        model_id = payload.get("model") if payload else None
+        breaker = self.breaker(model_id) if model_id else None
+        max_retries = self.max_retries if retries is None else retries
+        attempt = 0
+        while True:
+            if breaker and not breaker.allow():
+                raise CircuitOpenError(f"Circuit breaker is open for model {model_id}")
+            try:
+                response = self.session.request(method, url, headers=headers, json=payload, timeout=self.timeout,
+                                                stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                upstream_requests_total.inc(model=model_id or '', status='error')
+                if breaker:
+                    breaker.record_failure()
+                if attempt >= max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning("OpenRouter request failed (%s), retrying in %.1fs", e, delay)
+            else:
+                upstream_requests_total.inc(model=model_id or '', status=response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    if breaker:
+                        breaker.record_success()
+                    # Сообщаем об отказе только для запросов к моделям, а не для самой проверки ключа
+                    if model_id and response.status_code in AUTH_ERROR_STATUSES and self.on_auth_error:
+                        self.on_auth_error(api_key)
+                    return response
+                # 429 относится к ключу пользователя, а не к доступности модели
+                if breaker and response.status_code >= 500:
+                    breaker.record_failure()
+                delay = _retry_after(response)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if attempt >= max_retries or delay > self.retry_after_max:
+                    return response
+                response.close()
+                logging.warning("OpenRouter returned %s, retrying in %.1fs", response.status_code, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+# Общий клиент для всех обращений к OpenRouter
+client = OpenRouterClient(OPENROUTER_CONNECT_TIMEOUT, OPENROUTER_READ_TIMEOUT, OPENROUTER_MAX_RETRIES,
+                          OPENROUTER_BACKOFF_BASE, OPENROUTER_BACKOFF_MAX, OPENROUTER_RETRY_AFTER_MAX,
+                          OPENROUTER_POOL_SIZE, CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET)
+
+# Время до первого фрагмента ответа по моделям, из него выбирается момент страховочного запроса
+latency_tracker = LatencyTracker(HEDGE_WINDOW)
+
+# Результаты проверки ключей по SHA-256 ключа, сам ключ в кэше не хранится
+api_key_cache = TTLCache(API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL)
+
+def _api_key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+def check_api_key(api_key: str) -> bool:
+    """Проверяет ключ через лёгкий эндпоинт сведений о ключе; результат кэшируется на API_KEY_CACHE_TTL.
+
+    Ошибки сети и 5xx не кэшируются и пробрасываются как requests.exceptions.RequestException.
+    """
+    key_hash = _api_key_hash(api_key)
+    cached = api_key_cache.get(key_hash)
+    if cached is not None:
+        return cached
+    response = client.get(API_VALIDATE_URL, api_key)
+    if response.status_code in AUTH_ERROR_STATUSES:
+        is_valid = False
+    else:
+        response.raise_for_status()
+        is_valid = True
+    api_key_cache.set(key_hash, is_valid)
+    return is_valid
+
+def forget_api_key(api_key: str):
+    api_key_cache.invalidate(_api_key_hash(api_key))
+
+def _build_payload(message, model_id, max_tokens, message_history, stream=False):
+    messages_payload = list(message_history) if message_history else []
+    messages_payload.append({"role": "user", "content": message})
+
+    payload = {
+        "model": model_id,
+        "messages": messages_payload,
         "max_tokens": max_tokens
     }
-    logging.info(f"Sending request to OpenRouter: {payload}")
-    try:
-        response = requests.post(API_URL, headers=headers, json=payload)
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def request_completion(message, api_key, model_id, max_tokens=4096, message_history=None):
+    """Возвращает текст ответа или None, если ответ пуст; ошибки сети и HTTP пробрасываются."""
+    payload = _build_payload(message, model_id, max_tokens, message_history)
+    logging.info("Sending request to OpenRouter: %s", CompactBody(payload), extra={'verbose': True})
+    with timed('upstream', model=model_id):
+        response = client.post(API_URL, api_key, payload)
         response.raise_for_status()
         data = response.json()
-        logging.info(f"Response from OpenRouter: {data}")
-        if data.get("choices"):
-            return data["choices"][0].get("message", {}).get("content", "")
+    logging.info("Response from OpenRouter: %s", CompactBody(data), extra={'verbose': True})
+    record_usage(model_id, data.get("usage"))
+    if data.get("choices"):
+        return data["choices"][0].get("message", {}).get("content", "")
+    return None
+
+def _cache_key(cache, message, model_id, max_tokens, message_history, fallback):
+    payload = _build_payload(message, model_id, max_tokens, message_history)
+    if fallback:
+        # Ответ со страховкой мог дать и резервная модель, поэтому он кэшируется отдельно
+        payload["models"] = [model_id, fallback.model_id]
+    return cache.key_for(payload)
+
+def _in_slot(slot, compute):
+    # Место занимается только на время настоящего обращения к OpenRouter: ответ из кэша
+    # и ожидание результата такого же запроса его не занимают
+    if slot is None:
+        return compute
+    def gated():
+        with slot():
+            return compute()
+    return gated
+
+def _stream_in_slot(slot, open_stream):
+    if slot is None:
+        return open_stream
+    def gated():
+        with slot():
+            yield from open_stream()
+    return gated
+
+def send_to_openrouter(message, api_key, model_id, max_tokens=4096, message_history=None, cache=None,
+                       fallback=None, slot=None):
+    try:
+        if fallback:
+            # Страховка опирается на время до первого фрагмента, поэтому ответ читается потоком
+            compute = lambda: ''.join(hedged_completion(message, api_key, model_id, fallback,
+                                                        max_tokens, message_history)) or None
+        else:
+            compute = lambda: request_completion(message, api_key, model_id, max_tokens, message_history)
+        compute = _in_slot(slot, compute)
+        if cache is not None:
+            # Одинаковые запросы получают ответ из кэша или результат уже выполняющегося запроса
+            key = _cache_key(cache, message, model_id, max_tokens, message_history, fallback)
+            content = cache.complete(key, compute)
+        else:
+            content = compute()
+        if content is not None:
+            return content
         else:
             logging.error("OpenRouter API returned no choices.")
             return "Извините, произошла ошибка при обработке вашего сообщения."
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error communicating with OpenRouter API: {e}")
+        logging.error("Error communicating with OpenRouter API: %s", e)
         return "Извините, не удалось связаться с OpenRouter API."
+
+def stream_completion(message, api_key, model_id, max_tokens=4096, message_history=None, retries=None):
+    """Генератор фрагментов ответа из SSE-потока (stream: true); ошибки сети, HTTP и потока пробрасываются."""
+    payload = _build_payload(message, model_id, max_tokens, message_history, stream=True)
+    logging.info("Sending streaming request to OpenRouter: %s", CompactBody(payload), extra={'verbose': True})
+    received = False
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        with client.post(API_URL, api_key, payload, stream=True, retries=retries) as response:
+            response.raise_for_status()
+            # SSE всегда в UTF-8; без charset в Content-Type requests предположил бы ISO-8859-1
+            response.encoding = 'utf-8'
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                # Пустые строки разделяют события, строки с ':' - служебные комментарии
+                if not line or line.startswith(':') or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    outcome = 'ok'
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    logging.warning("Malformed SSE chunk from OpenRouter: %s", CompactBody(data))
+                    continue
+                if chunk.get("error"):
+                    raise StreamError(f"OpenRouter stream returned an error: {chunk['error']}")
+                # Последний фрагмент потока содержит статистику usage
+                record_usage(model_id, chunk.get("usage"))
+                choices = chunk.get("choices") or [{}]
+                content = choices[0].get("delta", {}).get("content")
+                if content:
+                    if not received:
+                        first_token = time.perf_counter() - started
+                        stage_duration.observe(first_token, stage='upstream_first_token', outcome='ok', model=model_id)
+                        latency_tracker.observe(model_id, first_token)
+                    received = True
+                    yield content
+            else:
+                outcome = 'ok'
+    finally:
+        # Включает время, которое потребитель тратит между фрагментами (редактирование сообщения)
+        stage_duration.observe(time.perf_counter() - started, stage='upstream_stream', outcome=outcome, model=model_id)
+
+def hedge_delay(model_id: str) -> float:
+    """Сколько ждать первый фрагмент ответа модели, прежде чем отправить страховочный запрос."""
+    learned = latency_tracker.percentile(model_id, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    return max(HEDGE_MIN_DELAY, HEDGE_DEFAULT_DELAY if learned is None else learned)
+
+def hedged_completion(message, api_key, model_id, fallback, max_tokens=4096, message_history=None):
+    """Как stream_completion, но медленный или недоступный ответ model_id подменяется ответом резервной модели."""
+    # Основной запрос не повторяется: вместо повтора после 5xx сразу отвечает резервная модель
+    open_primary = lambda: stream_completion(message, api_key, model_id, max_tokens, message_history, retries=0)
+    # У резервной модели своё окно: история и max_tokens подобраны под него вызывающим
+    open_fallback = lambda: stream_completion(message, api_key, fallback.model_id, fallback.max_tokens,
+                                              fallback.message_history)
+    return hedged_stream(open_primary, open_fallback, hedge_delay(model_id))
+
+def stream_from_openrouter(message, api_key, model_id, max_tokens=4096, message_history=None, cache=None,
+                           fallback=None, slot=None):
+    """Генератор фрагментов ответа; ошибка до первого фрагмента заменяется сообщением для пользователя."""
+    if fallback:
+        open_stream = lambda: hedged_completion(message, api_key, model_id, fallback, max_tokens,
+                                                message_history)
+    else:
+        open_stream = lambda: stream_completion(message, api_key, model_id, max_tokens, message_history)
+    open_stream = _stream_in_slot(slot, open_stream)
+    if cache is not None:
+        key = _cache_key(cache, message, model_id, max_tokens, message_history, fallback)
+        chunks = cache.stream(key, open_stream)
+    else:
+        chunks = open_stream()
+    received = False
+    try:
+        for chunk in chunks:
+            received = True
+            yield chunk
+    except requests.exceptions.RequestException as e:
+        logging.error("Error communicating with OpenRouter API: %s", e)
+        if not received:
+            yield "Извините, не удалось связаться с OpenRouter API."
+        return
+    if not received:
+        logging.error("OpenRouter API returned no choices.")
+        yield "Извините, произошла ошибка при обработке вашего сообщения."
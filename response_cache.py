@@ -0,0 +1,181 @@
+#response_cache.py
+# Кэш готовых ответов модели и объединение одинаковых запросов, выполняющихся одновременно
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from cache import TTLCache
+from db import get_cached_response, save_cached_response, purge_cached_responses
+from metrics import response_cache_total
+
+logger = logging.getLogger(__name__)
+
+# Как часто (в сохранённых ответах) из таблицы удаляются устаревшие строки
+PURGE_EVERY = 100
+
+
+class _Abandoned(Exception):
+    """Запрос-лидер прерван без ответа (например, поток не дочитан); ожидающие отправляют свой запрос."""
+
+
+class ResponseCache:
+    """Ответы по ключу sha256(модель, max_tokens, сообщения, резервная модель) в LRU-кэше с TTL.
+
+    Промах по ключу, запрос с которым уже выполняется, не порождает второго обращения к
+    OpenRouter: ожидающие получают результат первого запроса (или его ошибку). С session_factory
+    ответы дополнительно сохраняются в таблицу response_cache и переживают перезапуск.
+    Пустые ответы и ошибки не кэшируются.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, session_factory=None, max_messages: int = 0,
+                 wait_timeout: float = None):
+        self.ttl = ttl
+        self.session_factory = session_factory
+        self.max_messages = max_messages
+        self.wait_timeout = wait_timeout
+        self.memory = TTLCache(maxsize, ttl)
+        self._inflight = {}  # ключ -> Future ответа выполняющегося запроса
+        self._lock = threading.Lock()
+        self._saved = 0
+
+    def key_for(self, payload: dict):
+        """Ключ кэша для тела запроса или None, если запрос не кэшируется."""
+        messages = payload['messages']
+        if self.max_messages and len(messages) > self.max_messages:
+            return None
+        # Пробелы по краям и повторные пробелы не влияют на ключ
+        normalized = [[message.get('role'), ' '.join(str(message.get('content') or '').split())]
+                      for message in messages]
+        fields = [payload['model'], payload.get('max_tokens'), normalized]
+        if payload.get('models'):
+            fields.append(payload['models'])
+        raw = json.dumps(fields, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def complete(self, key, compute):
+        """Ответ из кэша, результат такого же выполняющегося запроса или compute()."""
+        if key is None:
+            return compute()
+        text, future, leader = self._lookup(key)
+        if text is not None:
+            return text
+        if not leader:
+            try:
+                return self._wait(future)
+            except (FutureTimeoutError, _Abandoned):
+                return compute()
+
+        text = self._load(key)
+        if text is not None:
+            self._finish(key, future, text)
+            return text
+        try:
+            text = compute()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, text, save=True)
+        return text
+
+    def stream(self, key, open_stream):
+        """Генератор фрагментов: ответ из кэша одним фрагментом или поток open_stream(), сохраняемый по завершении."""
+        if key is None:
+            yield from open_stream()
+            return
+        text, future, leader = self._lookup(key)
+        if text is not None:
+            yield text
+            return
+        if not leader:
+            try:
+                text = self._wait(future)
+            except (FutureTimeoutError, _Abandoned):
+                yield from open_stream()
+                return
+            if text:
+                yield text
+            return
+
+        text = self._load(key)
+        if text is not None:
+            self._finish(key, future, text)
+            yield text
+            return
+        parts = []
+        try:
+            for chunk in open_stream():
+                parts.append(chunk)
+                yield chunk
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, ''.join(parts), save=True)
+
+    def purge(self) -> int:
+        if self.session_factory is None:
+            return 0
+        with self.session_factory() as session:
+            return purge_cached_responses(self.ttl, session)
+
+    def _lookup(self, key):
+        # Проверка кэша и регистрация запроса под одной блокировкой: между ними не вклинится второй лидер
+        with self._lock:
+            text = self.memory.get(key)
+            if text is not None:
+                response_cache_total.inc(result='hit')
+                return text, None, False
+            future = self._inflight.get(key)
+            if future is not None:
+                response_cache_total.inc(result='coalesced')
+                return None, future, False
+            future = self._inflight[key] = Future()
+            return None, future, True
+
+    def _wait(self, future):
+        try:
+            return future.result(self.wait_timeout)
+        except FutureTimeoutError:
+            logger.warning("Coalesced request timed out, sending a separate one")
+            raise
+
+    def _load(self, key):
+        if self.session_factory is not None:
+            try:
+                with self.session_factory() as session:
+                    row = get_cached_response(key, self.ttl, session)
+            except Exception:
+                logger.exception("Failed to read the persisted response cache")
+                row = None
+            if row is not None:
+                response, created_at = row
+                response_cache_total.inc(result='stored')
+                # Сохранённый ответ живёт в памяти только оставшуюся часть своего TTL
+                self.memory.set(key, response, ttl=max(0.0, created_at + self.ttl - time.time()))
+                return response
+        response_cache_total.inc(result='miss')
+        return None
+
+    def _finish(self, key, future, text=None, error=None, save=False):
+        with self._lock:
+            # Ответ из таблицы уже помещён в память в _load() с оставшимся временем жизни
+            if save and text:
+                self.memory.set(key, text)
+            del self._inflight[key]
+        if error is not None:
+            future.set_exception(error if isinstance(error, Exception) else _Abandoned())
+            return
+        future.set_result(text)
+        if save and text and self.session_factory is not None:
+            self._save(key, text)
+
+    def _save(self, key, text):
+        try:
+            with self.session_factory() as session:
+                save_cached_response(key, text, session)
+                self._saved += 1
+                if self._saved % PURGE_EVERY == 0:
+                    purge_cached_responses(self.ttl, session)
+        except Exception:
+            logger.exception("Failed to persist a cached response")
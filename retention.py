@@ -0,0 +1,78 @@
+#retention.py
+# Фоновая очистка старой истории сообщений и возврат освободившегося места
+import logging
+import threading
+from datetime import datetime, timedelta
+from db import prune_old_messages, prune_excess_messages, incremental_vacuum
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionJob:
+    """Раз в interval секунд удаляет сообщения старше max_age_days и сверх max_per_user у пользователя.
+
+    Старые сообщения удаляются пачками по batch_size строк, каждая в своей транзакции, чтобы не
+    держать блокировку записи SQLite долго. После удаления свободные страницы возвращаются
+    файловой системе через PRAGMA incremental_vacuum.
+    """
+
+    def __init__(self, session_factory, max_age_days: int = 0, max_per_user: int = 0,
+                 interval: float = 3600, batch_size: int = 1000, vacuum_pages: int = 0):
+        self.session_factory = session_factory
+        self.max_age_days = max_age_days
+        self.max_per_user = max_per_user
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_age_days or self.max_per_user)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running or not self.enabled:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='message-retention', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        if not self.running:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Message retention pass failed")
+            if self._stopping.wait(self.interval):
+                return
+
+    def run_once(self) -> int:
+        deleted = 0
+        with timed('db_retention'), self.session_factory() as session:
+            if self.max_age_days:
+                cutoff = datetime.now() - timedelta(days=self.max_age_days)
+                while not self._stopping.is_set():
+                    count = prune_old_messages(cutoff, session, self.batch_size)
+                    deleted += count
+                    if count < self.batch_size:
+                        break
+            if self.max_per_user and not self._stopping.is_set():
+                deleted += prune_excess_messages(self.max_per_user, session)
+            engine = session.get_bind()
+        if deleted:
+            incremental_vacuum(engine, self.vacuum_pages)
+            logger.info("Message retention removed %d messages", deleted)
+        return deleted
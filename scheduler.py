@@ -0,0 +1,102 @@
+#scheduler.py
+# Асинхронный планировщик обновлений Telegram
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateScheduler:
+    """Обрабатывает обновления разных чатов параллельно, а обновления одного чата - по порядку.
+
+    Цикл asyncio работает в отдельном потоке. Для каждого чата ведётся очередь задач,
+    которую разбирает одна корутина, поэтому порядок внутри чата сохраняется. Общее число
+    одновременно выполняемых задач ограничено семафором (max_in_flight). Сами обработчики
+    остаются синхронными и выполняются в пуле потоков того же размера.
+
+    Цикл и пул создаются в start(), а не в конструкторе: процессы, порождённые через fork до
+    запуска, не делят между собой epoll и канал пробуждения цикла.
+    """
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.loop = None
+        self._executor = None
+        self._thread = None
+        self._semaphore = None
+        self._chat_queues = {}  # chat_id -> deque задач
+        self._idle = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='update-worker')
+        self._thread = threading.Thread(target=self._run_loop, name='update-scheduler', daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.loop.run_forever()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self.loop is not None and self.loop.is_running()
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """Ставит func(*args, **kwargs) в очередь чата chat_id. Можно вызывать из любого потока."""
+        self.loop.call_soon_threadsafe(self._enqueue, chat_id, func, args, kwargs)
+
+    def _enqueue(self, chat_id, func, args, kwargs):
+        queue = self._chat_queues.get(chat_id)
+        if queue is None:
+            queue = self._chat_queues[chat_id] = deque()
+            self._idle.clear()
+            self.loop.create_task(self._drain(chat_id, queue))
+        queue.append((func, args, kwargs))
+
+    async def _drain(self, chat_id, queue):
+        try:
+            while queue:
+                func, args, kwargs = queue.popleft()
+                async with self._semaphore:
+                    try:
+                        await self.loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+                    except Exception:
+                        logger.exception("Unhandled error while processing update for chat %s", chat_id)
+        finally:
+            del self._chat_queues[chat_id]
+            if not self._chat_queues:
+                self._idle.set()
+
+    def wrap(self, handler):
+        """Оборачивает обработчик python-telegram-bot так, чтобы он выполнялся через планировщик."""
+        @wraps(handler)
+        def dispatch(update, context, *args, **kwargs):
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            self.submit(chat_id, handler, update, context, *args, **kwargs)
+        return dispatch
+
+    def stop(self, timeout: float = 30):
+        """Дожидается обработки уже поставленных в очередь обновлений и останавливает цикл."""
+        if not self.running:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._idle.wait(), self.loop).result(timeout)
+        except Exception:
+            logger.warning("Update scheduler stopped with pending updates")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+        if not self.loop.is_running():
+            self.loop.close()
+        self.loop = None
+        self._executor = None
+        self._thread = None
@@ -0,0 +1,229 @@
+#sender.py
+# Исходящие сообщения Telegram: разбиение длинных ответов, соблюдение лимитов Bot API и индикатор "печатает..."
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from telegram import ChatAction
+from telegram.error import RetryAfter, TelegramError
+
+from cache import TTLCache
+from limits import Pacer
+from metrics import stage_duration, telegram_flood_waits_total
+
+logger = logging.getLogger(__name__)
+
+FENCE = '```'
+# Самая длинная строка, открывающая блок кода заново в следующей части, - доля от limit;
+# длинная info-строка обрезается, язык в её начале сохраняется
+REOPEN_SHARE = 4
+
+
+def _toggles_fence(line: str) -> bool:
+    return line.lstrip().startswith(FENCE)
+
+
+def _cut(line: str, size: int):
+    # Строка длиннее size режется по последнему пробелу, а если его нет - по длине
+    if len(line) <= size:
+        return line, ''
+    cut = line.rfind(' ', 0, size)
+    cut = cut + 1 if cut > 0 else size
+    return line[:cut], line[cut:]
+
+
+def split_message(text: str, limit: int) -> list:
+    """Делит текст на части не длиннее limit по границам строк.
+
+    Блок кода, попавший на границу, закрывается в конце части и открывается заново (с тем же
+    языком) в начале следующей, поэтому каждая часть остаётся целостной.
+    """
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    current = start = ''  # start - открытие блока кода заново, с которого началась текущая часть
+    fence = None  # строка, открывающая заново ещё не закрытый блок кода
+    closing = len(FENCE) + 1
+    for line in text.splitlines(keepends=True):
+        while line:
+            # Худший случай части: открытие блока заново, этот фрагмент и закрытие блока
+            reopen = len(fence) + 1 if fence else 0
+            piece, line = _cut(line, max(1, limit - reopen - closing))
+            after = (None if fence else piece.strip()[:limit // REOPEN_SHARE]) if _toggles_fence(piece) else fence
+            if len(current) + len(piece) + (closing if after else 0) > limit:
+                # Пустые строки на границе частей отбрасываются, а не отправляются отдельной частью
+                if current[len(start):].strip():
+                    if fence:
+                        current += ('' if current.endswith('\n') else '\n') + FENCE
+                    chunks.append(current)
+                current = start = fence + '\n' if fence else ''
+            current += piece
+            fence = after
+    if current[len(start):].strip():
+        chunks.append(current)
+    return chunks
+
+
+class TelegramSender:
+    """Единая точка отправки сообщений в Telegram.
+
+    Каждая отправка и редактирование ждут своей очереди по двум ограничениям: общему для бота
+    (около 30 сообщений в секунду) и отдельному для чата (около 1 в секунду, в группах - 20 в
+    минуту). Ожидание происходит в потоке обработчика этого чата, поэтому ответ 429 с
+    retry_after задерживает только свой чат. Индикаторы "печатает..." всех чатов обновляет
+    один фоновый поток, и в каждый чат уходит не больше одного действия за typing_interval.
+    """
+
+    def __init__(self, message_limit: int = 4096, global_rate: float = 30, global_burst: float = 30,
+                 chat_rate: float = 1, chat_burst: float = 3, group_rate: float = 20 / 60,
+                 typing_interval: float = 4, max_retries: int = 3):
+        self.message_limit = message_limit
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.typing_interval = typing_interval
+        self.max_retries = max_retries
+        self._global = Pacer(global_rate, global_burst)
+        self._chats = TTLCache(100000, 3600)  # chat_id -> Pacer
+        self._lock = threading.Lock()
+        # Последние отправленные действия: (chat_id, действие) -> True, живут typing_interval секунд
+        self._actions = TTLCache(100000, typing_interval)
+        self._typing = {}  # chat_id -> [bot, число активных блоков typing()]
+        self._executor = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='chat-action')
+        self._thread = threading.Thread(target=self._typing_loop, name='chat-actions', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        if not self.running:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+    def _chat_pacer(self, chat_id) -> Pacer:
+        pacer = self._chats.get(chat_id)
+        if pacer is None:
+            # Отрицательные chat_id - группы и каналы, для них лимит Telegram строже
+            pacer = Pacer(self.group_rate if chat_id < 0 else self.chat_rate, self.chat_burst)
+        self._chats.set(chat_id, pacer)
+        return pacer
+
+    def _reserve(self, chat_id, wait: bool) -> bool:
+        """Занимает ближайший разрешённый момент отправки и ждёт его; без wait - только если ждать не нужно.
+
+        Сначала ожидается очередь чата (в том числе retry_after после 429), и только затем берётся
+        ближайший общий слот бота. Чат, которому Telegram велел подождать, не занимает общих слотов
+        и не задерживает остальные чаты.
+        """
+        started = time.monotonic()
+        with self._lock:
+            chat = self._chat_pacer(chat_id)
+            at = chat.earliest(started)
+            if not wait and (at > started or self._global.earliest(started) > started):
+                return False
+            chat.commit(at)
+        while True:
+            now = time.monotonic()
+            if at > now:
+                time.sleep(at - now)
+            with self._lock:
+                now = time.monotonic()
+                # Пока чат ждал, Telegram мог продлить его блокировку
+                at = chat.blocked_until
+                if at <= now:
+                    at = self._global.earliest(now)
+                    self._global.commit(at)
+                    break
+        if at > now:
+            time.sleep(at - now)
+        waited = time.monotonic() - started
+        if waited > 1e-3:
+            stage_duration.observe(waited, stage='telegram_pacing', outcome='ok')
+        return True
+
+    def _call(self, chat_id, method, wait: bool = True):
+        """Вызывает method() в разрешённый момент; при 429 ждёт retry_after только этот чат."""
+        for attempt in range(self.max_retries + 1):
+            if not self._reserve(chat_id, wait):
+                return None
+            try:
+                return method()
+            except RetryAfter as e:
+                telegram_flood_waits_total.inc()
+                logger.warning("Telegram flood limit for chat %s, retrying in %s s", chat_id, e.retry_after)
+                with self._lock:
+                    self._chat_pacer(chat_id).block(time.monotonic() + e.retry_after)
+                if attempt == self.max_retries or not wait:
+                    raise
+        return None
+
+    def send_message(self, bot, chat_id, text: str, **kwargs) -> list:
+        """Отправляет текст одним или несколькими сообщениями; возвращает отправленные сообщения."""
+        return [self._call(chat_id, lambda part=part: bot.send_message(chat_id=chat_id, text=part, **kwargs))
+                for part in split_message(text, self.message_limit)]
+
+    def reply(self, message, text: str, **kwargs) -> list:
+        return self.send_message(message.bot, message.chat_id, text, **kwargs)
+
+    def edit(self, message, text: str, wait: bool = True) -> bool:
+        """Редактирует сообщение; без wait редактирование пропускается (False), если лимит чата исчерпан."""
+        try:
+            return self._call(message.chat_id, lambda: message.edit_text(text), wait=wait) is not None
+        except RetryAfter:
+            if wait:
+                raise
+            return False
+
+    def chat_action(self, bot, chat_id, action: str = ChatAction.TYPING):
+        """Отправляет действие, если такое же не уходило в этот чат последние typing_interval секунд."""
+        with self._lock:
+            if self._actions.get((chat_id, action)) is not None:
+                return
+            self._actions.set((chat_id, action), True)
+        try:
+            bot.send_chat_action(chat_id=chat_id, action=action)
+        except TelegramError as e:
+            logger.warning("Failed to send %s action to chat %s: %s", action, chat_id, e)
+
+    @contextmanager
+    def typing(self, bot, chat_id):
+        """Поддерживает индикатор "печатает..." в чате, пока выполняется блок with."""
+        if not self.running:
+            self.chat_action(bot, chat_id)
+            yield
+            return
+        with self._lock:
+            entry = self._typing.setdefault(chat_id, [bot, 0])
+            entry[1] += 1
+        self._executor.submit(self.chat_action, bot, chat_id)
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._typing[chat_id]
+
+    def _typing_loop(self):
+        # Один проход за интервал обновляет индикатор во всех чатах, где идёт обработка
+        while not self._stopping.wait(self.typing_interval / 4):
+            with self._lock:
+                chats = [(bot, chat_id) for chat_id, (bot, _) in self._typing.items()]
+            for bot, chat_id in chats:
+                self._executor.submit(self.chat_action, bot, chat_id)
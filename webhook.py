@@ -0,0 +1,136 @@
+#webhook.py
+# Приём обновлений Telegram через webhook и распределение их по процессам-обработчикам
+import json
+import logging
+import multiprocessing
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update: dict) -> int:
+    """Чат, к которому относится обновление; для обновлений без чата - отправитель или номер обновления."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        sender = value.get('from') or value.get('user')
+        if sender:
+            return sender['id']
+    return update.get('update_id', 0)
+
+
+class WorkerPool:
+    """Процессы-обработчики, у каждого своя очередь обновлений.
+
+    Обновление направляется в процесс chat_id % workers, поэтому обновления одного чата
+    обрабатываются одним процессом в порядке поступления. target(index, updates) получает
+    тела обновлений (bytes) из очереди и завершается, получив None. Процессы создаются через
+    fork и наследуют настройки родителя. Упавший процесс перезапускается с новой очередью,
+    необработанные обновления его доли чатов при этом теряются.
+    """
+
+    def __init__(self, target, workers: int, queue_size: int):
+        self.target = target
+        self.context = multiprocessing.get_context('fork')
+        self.queue_size = queue_size
+        self.queues = [self.context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+
+    def _spawn(self, index: int):
+        process = self.context.Process(target=self.target, args=(index, self.queues[index]),
+                                       name=f'update-worker-{index}')
+        process.start()
+        self.processes[index] = process
+
+    def route(self, chat_id: int, body: bytes) -> bool:
+        """Ставит обновление в очередь процесса чата; False, если очередь переполнена."""
+        try:
+            self.queues[chat_id % len(self.queues)].put_nowait(body)
+            return True
+        except queue.Full:
+            return False
+
+    def check(self):
+        # Процесс, погибший внутри updates.get(), не освобождает блокировку чтения очереди, и новый
+        # процесс из неё ничего не получит. Поэтому он получает новую очередь, а обновления,
+        # оставшиеся в старой, теряются (Telegram уже получил на них ответ 200)
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                old = self.queues[index]
+                try:
+                    dropped = old.qsize()
+                except NotImplementedError:
+                    dropped = '?'
+                logger.error("Update worker %d exited with code %s, restarting; %s queued updates dropped",
+                             index, process.exitcode, dropped)
+                old.close()
+                old.cancel_join_thread()
+                self.queues[index] = self.context.Queue(self.queue_size)
+                self._spawn(index)
+
+    def stop(self, timeout: float = 30):
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Update worker %s did not stop in time, terminating", process.name)
+                process.terminate()
+        self.processes = [None] * len(self.queues)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    # Telegram открывает до max_connections одновременных соединений
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def __init__(self, address, path: str, pool: WorkerPool, secret: str = None):
+        super().__init__(address, _WebhookHandler)
+        self.path = path
+        self.pool = pool
+        self.secret = secret
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        if self.path.split('?')[0] != server.path:
+            self._reply(404)
+            return
+        if server.secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != server.secret:
+            self._reply(403)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        try:
+            update = json.loads(body)
+        except ValueError:
+            self._reply(400)
+            return
+        # Ответ не ждёт обработки; при 503 Telegram повторит доставку позже
+        self._reply(200 if server.pool.route(update_chat_id(update), body) else 503)
+
+    def _reply(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_webhook_server(host: str, port: int, path: str, pool: WorkerPool, secret: str = None) -> WebhookServer:
+    server = WebhookServer((host, port), path, pool, secret)
+    threading.Thread(target=server.serve_forever, name='webhook-server', daemon=True).start()
+    logger.info("Webhook endpoint listening on http://%s:%s%s", *server.server_address[:2], path)
+    return server
@@ -0,0 +1,168 @@
+#writer.py
+# Фоновая пакетная запись сообщений (group commit)
+import logging
+import threading
+import time
+from collections import Counter
+from models import Message
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """Накапливает новые сообщения и записывает их пачками, одной транзакцией на пачку.
+
+    Пачка сбрасывается, когда набралось batch_size строк или прошло flush_interval секунд с
+    появления первой строки. sync_user() дожидается записи всех сообщений пользователя, поэтому
+    чтение истории сразу после ответа видит только что сохранённый ход. Пока поток записи не
+    запущен, сообщения записываются синхронно.
+
+    Неудачная пачка повторяется до retries раз (например, при истёкшем busy_timeout), затем
+    строки записываются по одной: ошибочная строка не лишает остальных пользователей их ходов.
+    Строки, которые так и не удалось записать, теряются; sync_user() и flush() тогда
+    возвращают False.
+    """
+
+    def __init__(self, session_factory, batch_size: int = 200, flush_interval: float = 0.05, retries: int = 2,
+                 retry_delay: float = 0.1):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._condition = threading.Condition()
+        self._queue = []
+        self._pending_users = Counter()
+        self._lost_users = Counter()  # пользователь -> число потерянных строк, ещё не сообщённых sync_user()
+        self._lost_since_flush = False
+        self._enqueued = 0  # порядковый номер последней поставленной в очередь строки
+        self._processed = 0  # порядковый номер последней обработанной (записанной или потерянной) строки
+        self.written = 0  # число строк, действительно записанных в базу
+        self.lost = 0  # число строк, которые не удалось записать
+        self._flush_requested = False
+        self._stopping = False
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, user_id: int, text: str, timestamp, direction: str, token_count: int = None):
+        row = dict(user_id=user_id, text=text, timestamp=timestamp, direction=direction, token_count=token_count)
+        if not self.running:
+            failed = self._write([row])
+            with self._condition:
+                self._account([row], failed)
+            return
+        with self._condition:
+            self._queue.append(row)
+            self._pending_users[user_id] += 1
+            self._enqueued += 1
+            self._condition.notify_all()
+
+    def sync_user(self, user_id: int, timeout: float = None) -> bool:
+        """Блокирует вызывающий поток, пока сообщения пользователя не будут записаны.
+
+        Возвращает False, если часть его сообщений записать не удалось или не дождались timeout.
+        """
+        with self._condition:
+            done = not self._pending_users[user_id] or self._wait_processed(self._enqueued, timeout)
+            return done and not self._lost_users.pop(user_id, 0)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Дожидается записи всей очереди; False, если со времени прошлого flush() строки терялись."""
+        with self._condition:
+            done = self._wait_processed(self._enqueued, timeout)
+            lost, self._lost_since_flush = self._lost_since_flush, False
+            return done and not lost
+
+    def _wait_processed(self, target: int, timeout: float) -> bool:
+        if self._processed >= target:
+            return True
+        self._flush_requested = True
+        self._condition.notify_all()
+        self._condition.wait_for(lambda: self._processed >= target or not self.running, timeout)
+        return self._processed >= target
+
+    def stop(self, timeout: float = 30):
+        """Записывает всё, что осталось в очереди, и останавливает поток записи."""
+        if not self.running:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._stopping)
+                # Небольшая задержка позволяет собрать в одну транзакцию сообщения из разных чатов
+                if not self._stopping and not self._flush_requested and len(self._queue) < self.batch_size:
+                    self._condition.wait_for(
+                        lambda: len(self._queue) >= self.batch_size or self._flush_requested or self._stopping,
+                        self.flush_interval)
+                batch = self._queue
+                self._queue = []
+                batch_end = self._enqueued
+                self._flush_requested = False
+                if not batch and self._stopping:
+                    return
+
+            failed = self._write(batch) if batch else []
+
+            with self._condition:
+                self._processed = batch_end
+                for row in batch:
+                    self._pending_users[row['user_id']] -= 1
+                    if not self._pending_users[row['user_id']]:
+                        del self._pending_users[row['user_id']]
+                self._account(batch, failed)
+                self._condition.notify_all()
+
+    def _account(self, rows, failed):
+        # Вызывается под self._condition
+        self.written += len(rows) - len(failed)
+        self.lost += len(failed)
+        for row in failed:
+            self._lost_users[row['user_id']] += 1
+            self._lost_since_flush = True
+
+    def _write(self, rows) -> list:
+        """Записывает строки; возвращает те, что записать не удалось."""
+        for attempt in range(self.retries + 1):
+            try:
+                self._insert(rows)
+                return []
+            except Exception as e:
+                error = e
+                if attempt == self.retries:
+                    logger.warning("Failed to write a batch of %d messages (%s), writing them one by one",
+                                   len(rows), e)
+                else:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        if len(rows) == 1:
+            logger.error("Message of user %s was not stored: %s", rows[0]['user_id'], error)
+            return rows
+        failed = []
+        for row in rows:
+            try:
+                self._insert([row])
+            except Exception:
+                logger.exception("Message of user %s was not stored", row['user_id'])
+                failed.append(row)
+        return failed
+
+    def _insert(self, rows):
+        with timed('db_write'), self.session_factory() as session:
+            session.bulk_insert_mappings(Message, rows)
+            session.commit()